@@ -1,45 +1,1200 @@
+import atexit
+import bisect
+import collections
+import contextlib
+import datetime
+import functools
+import importlib
+import itertools
+import json
+import numbers
+import os
+import queue
+import re
 import sqlite3
+import threading
+import time
 
-import pandas as pd
+
+class LazyModule:
+    """
+    Module, that is imported on the first access to its attributes.
+    Transactions don't need pandas, asyncio and process pools, so only imports,
+    reports and AsyncMarket pay for their import.
+
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+
+asyncio = LazyModule('asyncio')
+futures = LazyModule('concurrent.futures')
+pd = LazyModule('pandas')
+
+
+def write_operation(method):
+    """Decorator of Market methods, that write into main database. See Market.write."""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return self.write(method, self, *args, **kwargs)
+
+    return wrapper
+
+
+def cached_report(method):
+    """Decorator of Market methods, that read reports. Their results are cached, see Market.cached."""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return self.cached(method, self, *args, **kwargs)
+
+    return wrapper
+
+
+class WriterThread(threading.Thread):
+    """
+    Thread, that executes all writes into connection one after another.
+    Calls, waiting in the queue, are committed together (group commit). Each call
+    runs in its own savepoint, so a failed call doesn't roll back the others.
+    If the batch can't be started or committed (e.g. database is locked by another
+    process longer than busy timeout), all its calls fail and the thread goes on.
+
+    """
+
+    def __init__(self, con, max_batch=100):
+        super().__init__(name='MarketWriter', daemon=True)
+        self.con = con
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.calls = 0
+        self.commits = 0
+        self.start()
+
+    def put(self, function, *args, **kwargs):
+        """Put call into the queue and return future of its result."""
+
+        future = futures.Future()
+        self.queue.put((future, function, args, kwargs))
+        return future
+
+    def submit(self, function, *args, timeout=None, **kwargs):
+        """
+        Put call into the queue and wait for its result at most timeout seconds.
+        Raise TimeoutError, if there is no result in time. The call is cancelled,
+        unless the thread has started it already.
+
+        """
+
+        if not self.is_alive():
+            raise RuntimeError('Writer thread is stopped')
+        future = self.put(function, *args, **kwargs)
+        try:
+            return future.result(timeout)
+        except futures.TimeoutError:
+            future.cancel()
+            raise TimeoutError('Write wasn\'t executed in %s s' % timeout)
+
+    def close(self):
+        """Execute calls left in the queue and stop the thread."""
+
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        stop = False
+        while not stop:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in batch
+            # Calls, cancelled by submit after timeout, are skipped
+            calls = [
+                call for call in batch
+                if call is not None and call[0].set_running_or_notify_cancel()
+            ]
+            if not calls:
+                continue
+
+            results = []
+            try:
+                self.con.execute('BEGIN IMMEDIATE')
+                for future, function, args, kwargs in calls:
+                    self.con.execute('SAVEPOINT call')
+                    try:
+                        results.append(
+                            (future, function(*args, **kwargs), None))
+                    except Exception as e:
+                        self.con.execute('ROLLBACK TO call')
+                        results.append((future, None, e))
+                    self.con.execute('RELEASE call')
+                self.con.commit()
+            except Exception as e:
+                if self.con.in_transaction:
+                    self.con.rollback()
+                results = [(call[0], None, e) for call in calls]
+
+            self.calls += len(results)
+            self.commits += 1
+            for future, result, error in results:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+
+class AuditLog:
+    """
+    Buffered writer of log_table.
+
+    Entries are kept in memory and inserted by batches from a background thread: when
+    the buffer reaches max_entries or every interval seconds. If the thread falls behind,
+    callers flush the buffer themselves. Everything left is flushed on close() and at exit.
+    In durable mode (or with durable=True in add) entries are committed before add returns.
+    Time of an entry is taken when it is added, not when it is flushed.
+
+    """
+
+    sql = '''insert into log_table(dttm,operation,subject,data) values(?,?,?,?)'''
+
+    def __init__(self, con, max_entries=1000, interval=1.0, durable=False):
+        self.con = con
+        self.max_entries = max_entries
+        self.interval = interval
+        self.durable = durable
+        self.buffer = []
+        self.buffer_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.entries = 0
+        self.flushes = 0
+        self.flush_time = 0.0
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run,
+                                       name='MarketAuditLog',
+                                       daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def add(self, operation, subject, data, durable=None):
+        """Add one entry to the log."""
+
+        self.add_many([(operation, subject, data)], durable)
+
+    def add_many(self, entries, durable=None):
+        """Add list of (operation, subject, data) to the log."""
+
+        dttm = datetime.datetime.now(
+            datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        with self.buffer_lock:
+            self.buffer.extend(
+                (dttm, operation, subject, data)
+                for operation, subject, data in entries)
+            size = len(self.buffer)
+
+        if durable or (durable is None and self.durable) or self.closed \
+                or size >= 4 * self.max_entries:
+            self.flush()
+        elif size >= self.max_entries:
+            self.wakeup.set()
+
+    def flush(self):
+        """
+        Insert all buffered entries in one transaction. Return number of entries.
+        If the insert fails (e.g. log database is locked), entries are put back
+        into the buffer before the error is raised, so the next flush writes them.
+
+        """
+
+        with self.flush_lock:
+            with self.buffer_lock:
+                entries, self.buffer = self.buffer, []
+            if not entries:
+                return 0
+            started = time.perf_counter()
+            try:
+                self.con.executemany(self.sql, entries)
+                self.con.commit()
+            except Exception:
+                self.con.rollback()
+                with self.buffer_lock:
+                    self.buffer[:0] = entries
+                raise
+            self.flush_time += time.perf_counter() - started
+            self.entries += len(entries)
+            self.flushes += 1
+            return len(entries)
+
+    def run(self):
+        while not self.closed:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print('Log wasn\'t flushed. Error:', e)
+
+    def close(self):
+        """Stop background thread and flush the buffer."""
+
+        if self.closed:
+            return
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+        atexit.unregister(self.close)
+
+    def stats(self):
+        """Return number of written entries, flushes, time of flushes and entries per second."""
+
+        return {
+            'entries': self.entries,
+            'flushes': self.flushes,
+            'buffered': len(self.buffer),
+            'flush_time': self.flush_time,
+            'entries_per_second':
+            self.entries / self.flush_time if self.flush_time else 0,
+        }
+
+
+class Metrics:
+    """
+    Instrumentation of Market: number of calls and histograms of latency of its methods,
+    number of executions, time and rows of each SQL statement, and trace of the last
+    executed statements. Market is instrumented only with Market(instrument=True),
+    otherwise neither methods nor connections are wrapped.
+
+    """
+
+    # Upper bounds of latency buckets, seconds
+    buckets = [1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1, float('inf')]
+    labels = ['10us', '100us', '1ms', '10ms', '100ms', '1s', 'inf']
+
+    def __init__(self, trace_size=100):
+        self.lock = threading.Lock()
+        self.methods = {}
+        self.statements = {}
+        self.trace_log = collections.deque(maxlen=trace_size)
+
+    def wrap(self, function, name):
+        """Return function, that records calls of function under name (and type of transaction)."""
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            label = name
+            if name == 'transactions_add':
+                label += '.%s' % kwargs.get('type', args[0] if args else None)
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(self.methods, label,
+                            time.perf_counter() - started)
+
+        return wrapper
+
+    def record(self, metrics, name, elapsed, rows=0, calls=1):
+        """Add call of method or statement with its latency and rows."""
+
+        with self.lock:
+            metric = metrics.get(name)
+            if metric is None:
+                metric = metrics[name] = {
+                    'calls': 0,
+                    'time': 0.0,
+                    'max': 0.0,
+                    'rows': 0,
+                    'histogram': [0] * len(self.buckets)
+                }
+            metric['calls'] += calls
+            metric['time'] += elapsed
+            metric['rows'] += rows
+            if calls:
+                metric['max'] = max(metric['max'], elapsed)
+            metric['histogram'][bisect.bisect_left(self.buckets,
+                                                   elapsed)] += calls
+
+    def statement(self, sql, elapsed, rows=0, calls=1):
+        """Add execution (calls=1) or fetch (calls=0) of SQL statement."""
+
+        self.record(self.statements, ' '.join(sql.split()), elapsed, rows,
+                    calls)
+
+    def trace(self, sql):
+        """Trace callback of connections: keep the last executed statements."""
+
+        self.trace_log.append(
+            (time.time(), threading.current_thread().name, sql))
+
+    def stats(self):
+        """Return dicts of metrics of methods and statements with mean latency and histogram by labels."""
+
+        with self.lock:
+            return {
+                kind: {
+                    name: dict(metric,
+                               mean=metric['time'] / metric['calls']
+                               if metric['calls'] else 0,
+                               histogram=dict(
+                                   zip(self.labels, metric['histogram'])))
+                    for name, metric in metrics.items()
+                }
+                for kind, metrics in (('methods', self.methods),
+                                      ('statements', self.statements))
+            }
+
+
+class TracedCursor(sqlite3.Cursor):
+    """Cursor, that records time and rows of its statements into Metrics of its connection."""
+
+    sql = None
+
+    def execute(self, sql, parameters=()):
+        self.sql = sql
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.connection.metrics.statement(sql,
+                                              time.perf_counter() - started,
+                                              max(self.rowcount, 0))
+
+    def executemany(self, sql, seq_of_parameters):
+        self.sql = sql
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.connection.metrics.statement(sql,
+                                              time.perf_counter() - started,
+                                              max(self.rowcount, 0))
+
+    def fetched(self, started, rows):
+        if self.sql is not None:
+            self.connection.metrics.statement(self.sql,
+                                              time.perf_counter() - started,
+                                              rows,
+                                              calls=0)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self.fetched(started, row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(size or self.arraysize)
+        self.fetched(started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self.fetched(started, len(rows))
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self.fetched(started, 0)
+            raise
+        self.fetched(started, 1)
+        return row
+
+
+class TracedConnection(sqlite3.Connection):
+    """Connection with TracedCursor. Its metrics are set by Market.connect."""
+
+    metrics = None
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
 
 
 class Market:
 
-    def __init__(self, name='dbo'):
+    # Columns of source csv files by table
+    import_layouts = {
+        'categories': ['id', 'title', 'description'],
+        'goods': ['id', 'title', 'price', 'categoryId'],
+        'customers': ['id', 'first_name', 'last_name', 'email', 'gender'],
+    }
+
+    # Source csv files and their tables in order of insertion
+    import_files = [
+        ('categoris_table.csv', 'categories'),
+        ('goods_table.csv', 'goods'),
+        ('Persons_table.csv', 'customers'),
+    ]
+
+    # PRAGMAs of main and log connections, can be overridden by pragmas argument
+    default_pragmas = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -64000,
+        'mmap_size': 268435456,
+    }
+
+    # Tables of main database, created by db_create
+    tables = [
+        'Goods', 'Locators', 'Customers', 'Categories', 'Deliveries',
+        'Transactions', 'Categories_sales', 'Customers_sales'
+    ]
+
+    log_table_sql = '''CREATE TABLE IF NOT EXISTS log_table(
+                    id integer not null primary key autoincrement,
+                    dttm date default current_timestamp,
+                    operation nvarchar(255),
+                    subject nvarchar(255),
+                    data nvarchar(255)
+                    )'''
+
+    # Backfill of daily rollups from Transactions, see rollups_add and rollups_rebuild
+    rollups_sql = [
+        '''INSERT INTO Revenue_daily(date, type, total, transactions)
+            SELECT date, type, round(sum(total), 2), count(*) FROM Transactions
+            WHERE date IS NOT NULL GROUP BY date, type''',
+        '''INSERT INTO Customers_daily(date, customer_id, orders)
+            SELECT date, customer_id, count(*) FROM Transactions
+            WHERE type = \'sell\' AND customer_id IS NOT NULL AND date IS NOT NULL
+            GROUP BY date, customer_id''',
+    ]
+
+    # Schema migrations: (version, description, statements). Version of database
+    # is kept in PRAGMA user_version, migrate() applies newer migrations in order.
+    migrations = [
+        (1, 'Indexes of hot queries', [
+            '''CREATE INDEX IF NOT EXISTS Transactions_date_type
+                ON Transactions(date, type)''',
+            '''CREATE INDEX IF NOT EXISTS Transactions_subject_type
+                ON Transactions(subject_id, type)''',
+            '''CREATE INDEX IF NOT EXISTS Goods_category
+                ON Goods(categoryId)''',
+            '''CREATE INDEX IF NOT EXISTS Goods_in_stock
+                ON Goods(title, price) WHERE delflg = 0''',
+            '''CREATE INDEX IF NOT EXISTS Customers_sales_customer
+                ON Customers_sales(customer_id, active)''',
+            '''CREATE INDEX IF NOT EXISTS Categories_sales_category
+                ON Categories_sales(category_id, active)''',
+        ]),
+        (2, 'Stock ledger', [
+            '''CREATE TABLE IF NOT EXISTS Settings(
+                name nvarchar(255) not null primary key,
+                value nvarchar(255)
+                )''',
+            '''INSERT OR IGNORE INTO Settings(name, value) VALUES('inventory', 'units')''',
+            '''CREATE TABLE IF NOT EXISTS Stock(
+                id integer not null primary key autoincrement,
+                title nvarchar(255),
+                price numeric,
+                categoryId integer,
+                quantity integer not null default 0 check(quantity >= 0),
+                unique(title, price, categoryId)
+                )''',
+            '''CREATE TABLE IF NOT EXISTS Stock_movements(
+                id integer not null primary key autoincrement,
+                stock_id integer not null,
+                type nvarchar(255),
+                quantity integer,
+                transaction_id integer,
+                date date default current_date
+                )''',
+            '''CREATE INDEX IF NOT EXISTS Stock_movements_stock_type
+                ON Stock_movements(stock_id, type)''',
+        ]),
+        (3, 'Daily rollups of transactions', [
+            '''CREATE TABLE IF NOT EXISTS Revenue_daily(
+                date date not null,
+                type nvarchar(255) not null,
+                total numeric not null default 0,
+                transactions integer not null default 0,
+                primary key(date, type)
+                ) WITHOUT ROWID''',
+            '''CREATE TABLE IF NOT EXISTS Customers_daily(
+                date date not null,
+                customer_id integer not null,
+                orders integer not null default 0,
+                primary key(date, customer_id)
+                ) WITHOUT ROWID''',
+            *rollups_sql,
+        ]),
+        (4, 'Version of discounts', [
+            '''INSERT OR IGNORE INTO Settings(name, value) VALUES('discounts_version', 0)''',
+            *[
+                '''CREATE TRIGGER IF NOT EXISTS %s_%s AFTER %s ON %s
+                   BEGIN
+                   UPDATE Settings SET value = value + 1 WHERE name = \'discounts_version\';
+                   END''' % (table, event.lower(), event, table)
+                for table in ['Customers_sales', 'Categories_sales']
+                for event in ['INSERT', 'UPDATE', 'DELETE']
+            ],
+        ]),
+    ]
+
+    # Inventory layouts: 'units' - one row of Goods per unit, 'ledger' - quantity of each
+    # article in Stock and all its changes in Stock_movements (see inventory_migrate)
+    inventory_modes = ['units', 'ledger']
+
+    # Signed totals of transactions by days, see revenue_stat
+    revenue_sql = '''select date, sum(case when type in (\'delivery\', \'return\')
+                                     then -total else total end) as total
+                     from Revenue_daily where date between ? and ?
+                     group by date order by date'''
+
+    # Number of days with sells, orders of each customer and orders of all customers
+    # between two dates, see user_stat. There is one row without customer, if there are no orders.
+    user_stat_sql = '''select Days.days, Orders.customer_id, Orders.orders,
+                              sum(Orders.orders) over () as total
+                       from (select count(*) as days from Revenue_daily
+                             where date between :start_date and :end_date
+                             and type = \'sell\') as Days
+                       left join (select customer_id, sum(orders) as orders
+                                  from Customers_daily
+                                  where date between :start_date and :end_date
+                                  group by customer_id) as Orders'''
+
+    # Claim of a unit of Goods by sell and back by return: only one of concurrent
+    # calls changes delflg, see transactions_add and sell_many
+    unit_claim_sql = '''update Goods set delflg = 1 where id = ? and delflg = 0'''
+    unit_return_sql = '''update Goods set delflg = 0 where id = ? and delflg = 1'''
+
+    # Total of the sell of returned unit of Goods
+    unit_refund_sql = '''select total from Transactions where Transactions.subject_id = ?
+                         and Transactions.type = \'sell\''''
+
+    # Claim of quantity of article in 'ledger' inventory: the check of quantity and the update are atomic
+    stock_claim_sql = '''update Stock set quantity = quantity - ? where id = ? and quantity >= ?'''
+    stock_return_sql = '''update Stock set quantity = quantity + ? where id = ?'''
+
+    # Sold and not yet returned quantity of article
+    stock_returnable_sql = '''select -sum(quantity) from Stock_movements
+                              where stock_id = ? and type in (\'sell\', \'return\')'''
+
+    # Price of a unit by the last sell of the article in 'ledger' inventory, or the price
+    # of article for sells before migration. Sells are found by their movements, as
+    # subject_id of sells before migration is id of Goods, not of Stock.
+    stock_refund_sql = '''select coalesce((select Transactions.total * 1.0 / Transactions.quantity
+                                           from Stock_movements
+                                           join Transactions
+                                           on Transactions.id = Stock_movements.transaction_id
+                                           where Stock_movements.stock_id = ?
+                                           and Stock_movements.type = \'sell\'
+                                           order by Stock_movements.id desc limit 1), price)
+                          from Stock where id = ?'''
+
+    # Article of Stock by title, price and category, see goods_add and stock_deliver
+    stock_article_sql = '''select id from Stock where title = ? and price = ? and categoryId = ?'''
+    stock_titles_sql = '''select id, title, price, categoryId from Stock where title in (%s)'''
+
+    # Prices and available units of goods by ids (list of '?'), see sell_prices
+    sell_prices_sql = {
+        'units': '''select id, price, categoryId, 1 from Goods
+                    where id in (%s) and delflg = ?''',
+        'ledger': '''select id, price, categoryId, quantity from Stock
+                     where id in (%s)''',
+    }
+
+    # Number of units of article in stock, see stock_level
+    stock_level_sql = {
+        'units': '''select count(*) from Goods as Article
+                    join Goods on Goods.title = Article.title and Goods.price = Article.price
+                               and Goods.categoryId is Article.categoryId and Goods.delflg = 0
+                    where Article.id = ?''',
+        'ledger': '''select quantity from Stock where id = ?''',
+    }
+
+    # Version of discounts, see discount_cache
+    discounts_version_sql = '''select value from Settings where name = \'discounts_version\''''
+
+    # Hot queries of the code above, that must be executed by index search
+    # (see check_query_plans and tests/test_query_plans.py)
+    hot_queries = {
+        'revenue_stat': (revenue_sql, ['2020-01-01', '2020-01-31']),
+        'user_stat': (user_stat_sql, {
+            'start_date': '2020-01-01',
+            'end_date': '2020-01-31'
+        }),
+        'unit_claim': (unit_claim_sql, [1]),
+        'unit_return': (unit_return_sql, [1]),
+        'unit_refund': (unit_refund_sql, [1]),
+        'unit_prices': (sell_prices_sql['units'] % '?', [1, 0]),
+        'unit_level': (stock_level_sql['units'], [1]),
+        'stock_claim': (stock_claim_sql, [1, 1, 1]),
+        'stock_return': (stock_return_sql, [1, 1]),
+        'stock_returnable': (stock_returnable_sql, [1]),
+        'stock_refund': (stock_refund_sql, [1, 1]),
+        'stock_article': (stock_article_sql, ['title', 1, 1]),
+        'stock_titles': (stock_titles_sql % '?', ['title']),
+        'stock_prices': (sell_prices_sql['ledger'] % '?', [1]),
+        'stock_level': (stock_level_sql['ledger'], [1]),
+        'discounts_version': (discounts_version_sql, []),
+    }
+
+    # Columns of delivery manifest and rules of their validation, see deliveries_import
+    manifest_columns = [
+        'title', 'price', 'category_id', 'quantity', 'additionalInfo'
+    ]
+    manifest_rules = [('title', 'title', 'not_empty'),
+                      ('price', 'price', 'number'),
+                      ('category_id', 'category_id', 'integer'),
+                      ('quantity', 'quantity', 'positive_integer')]
+
+    # Movement of Stock in ledger inventory
+    movement_insert_sql = '''insert into Stock_movements(stock_id, type, quantity, transaction_id, date)
+                            values(?,?,?,?,?)'''
+
+    # Insert of sell transaction, shared by transactions_add and sell_many
+    sell_insert_sql = '''insert into Transactions(type, total, subject_id, quantity, customer_id, discount,
+                                                    additionalInfo, date)
+                        values(?,?,?,?,?,?,?,?)'''
+
+    # Seconds, that write waits for the writer thread in concurrent mode. Default: no limit
+    write_timeout = None
+
+    # Number of prepared statements cached by each connection
+    cached_statements = 256
+
+    # Number of rejected and malformed rows of each table, kept by streaming import
+    # (see import_stream). All of them are counted in rejected_counts and malformed_counts.
+    sample_size = 10000
+
+    # Number of rows, fetched at once by readers (see query)
+    read_batch_size = 1000
+
+    # Number of results of reports, kept by cached
+    report_cache_size = 128
+
+    # Methods, measured by Market(instrument=True), see Metrics
+    instrumented_methods = [
+        'csv_import', 'import_stream', 'parallel_import', 'bulk_insert',
+        'locators_insert', 'delivery_add', 'deliveries_import', 'goods_add',
+        'transactions_add', 'sell_many', 'category_sale_add',
+        'customer_sale_add', 'inventory_migrate', 'rollups_rebuild',
+        'revenue_stat', 'user_stat', 'table_size', 'stock_level', 'db_print',
+        'goods_cats', 'sql_execution', 'snapshot', 'restore'
+    ]
+
+    # Log entries are flushed, when there are so many of them or every so many seconds
+    log_buffer_size = 1000
+    log_flush_interval = 1.0
+
+    def __init__(self,
+                 name='dbo',
+                 chunksize=None,
+                 batch_size=10000,
+                 parallel=False,
+                 workers=None,
+                 pragmas=None,
+                 concurrent=False,
+                 durable_log=False,
+                 rebuild=False,
+                 inventory=None,
+                 instrument=False,
+                 stats_interval=None,
+                 files=None,
+                 snapshot=None):
         """
         Initialize a database and all required tables.
         Original data imports from csv file, validates and then inserts into db.
+        If the database already contains all tables, it is opened as is: tables
+        aren't dropped, csv files aren't imported, only new migrations are applied.
 
         Parameters
         ----------
             database : Database's name. Can be w/- or w/o '.db' at the end. Default: dbo
+                       ':memory:' creates main and log databases in memory, they are
+                       dropped on close (see snapshot to keep them).
 
             log_db : Database's name, that logs information about all changes in main DB.
 
+            chunksize : If set, csv files are imported in streaming mode by chunks of this size
+                        (see import_stream). Dataframes below are not kept in this case.
+
+            batch_size : Number of rows, inserted in one transaction during import. Default: 10000
+
+            parallel : If True, csv files are converted and validated on a process pool
+                       (see parallel_import). On spawn platforms Market must be created
+                       under "if __name__ == '__main__':".
+
+            workers : Number of processes for parallel import. Default: number of CPUs
+
+            pragmas : Dict of PRAGMAs, applied to connections over default_pragmas,
+                      e.g. {'synchronous': 'FULL'}
+
+            concurrent : If True, Market can be shared by threads. All writes are executed by
+                         one writer thread with group commit (see WriterThread), read-only
+                         queries run in parallel on read-only connections of each thread (see reader).
+                         Requires journal_mode WAL.
+
+            rebuild : If True, tables are dropped, created and filled from csv files
+                      even if the database exists.
+
+            inventory : 'units' or 'ledger', see inventory_modes. The layout is kept in the
+                        database: None opens it as is, 'ledger' migrates 'units' database
+                        by inventory_migrate. Ledger database can't be switched back.
+
+            created : True, if tables were created and filled from csv files.
+
+            durable_log : If True, each log entry is committed by add_log. Otherwise entries
+                          are buffered and written by batches (see AuditLog).
+
+            con, log_con : Connections to main and log databases. They are opened once and
+                           kept until close(). Market can be used as a context manager.
+
+            log : AuditLog of log_con. log.stats() shows log throughput.
+
+            discounts : Cache of active discounts, see discount_cache and discount_stats.
+
+            writes : Number of writes, see write. Together with PRAGMA data_version it shows,
+                     whether cached reports are up to date (see cached and cache_stats).
+
+            instrument : If True, calls of instrumented_methods and SQL statements of all
+                         connections are measured (see Metrics and stats). Otherwise
+                         nothing is wrapped and there is no overhead.
+
+            stats_interval : If set, stats are written into log_table every so many seconds
+                             (see stats_dump).
+
+            files : Dict of source csv files by table (categories, goods, customers) over
+                    import_files. File is a path or a text file-like object.
+
+            snapshot : Path of database or sqlite3 connection, e.g. result of snapshot().
+                       It's copied into the database by backup API instead of csv import.
+
             category_df, goods_df, customers_df, locators_df : Dataframes with data, prepared to insert into database
 
+            malformed : Dict of dataframes with source lines, that couldn't be split into columns, by table
+
+            rejected : Dict of dataframes with rows, that failed validation, by table. See rules_validation.
+                       In streaming mode only the first sample_size rows are kept.
+
+            malformed_counts, rejected_counts : Numbers of malformed and rejected rows by table
+
+        """
+
+        if name == ':memory:':
+            if concurrent:
+                raise ValueError(
+                    'Database in memory can\'t be used in concurrent mode')
+            self.database = self.log_db = name
+        else:
+            self.database = self.dbname_check(name)
+            self.log_db = 'log_' + self.dbname_check(name)
+        self.import_files = [((files or {}).get(table, file), table)
+                             for file, table in Market.import_files]
+        self.batch_size = batch_size
+        self.malformed = {}
+        self.rejected = {}
+        self.malformed_counts = {}
+        self.rejected_counts = {}
+        self.pragmas = dict(self.default_pragmas, **(pragmas or {}))
+        self.metrics = Metrics() if instrument else None
+        self.con = self.connect(self.database)
+        try:
+            if snapshot is not None:
+                self.backup_from(snapshot)
+            self.created = rebuild or not self.schema_exists()
+        except Exception:
+            self.con.close()
+            raise
+        self.log_con = self.connect(self.log_db)
+        self.log = AuditLog(self.log_con, self.log_buffer_size,
+                            self.log_flush_interval, durable_log)
+        self.writer = None
+        self.writing = False
+        self.readers = threading.local()
+        self.reader_cons = []
+        self.discounts = None
+        self.discounts_version = None
+        self.discount_hits = 0
+        self.discount_misses = 0
+        self.writes = 0
+        self.version_con = None
+        self.reports = collections.OrderedDict()
+        self.reports_lock = threading.Lock()
+        self.report_stats = dict.fromkeys(
+            ['hits', 'misses', 'stale', 'evictions'], 0)
+        self.stats_thread = None
+        self.stats_stop = threading.Event()
+        if self.metrics is not None:
+            for method in self.instrumented_methods:
+                setattr(self, method,
+                        self.metrics.wrap(getattr(self, method), method))
+
+        if not self.created:
+            self.category_df = None
+            self.goods_df = None
+            self.customers_df = None
+            self.locators_df = None
+            self.log_con.execute(self.log_table_sql)
+            self.log_con.commit()
+
+        elif parallel:
+            self.db_create()
+            self.parallel_import(self.import_files, chunksize, workers)
+
+        elif chunksize:
+            self.db_create()
+            self.category_df = None
+            self.goods_df = None
+            self.customers_df = None
+            self.locators_df = None
+            for file, table in self.import_files:
+                self.import_stream(file, table, chunksize)
+
+        else:
+            self.db_create()
+            files = {table: file for file, table in self.import_files}
+            self.category_df, self.rejected['categories'] = self.category_validation(
+                self.csv_import(file=files['categories'], table='categories'))
+            self.category_insert()
+
+            self.goods_df, self.rejected['goods'] = self.goods_validation(
+                self.csv_import(file=files['goods'], table='goods'))
+            self.goods_insert()
+
+            self.customers_df, self.rejected['customers'] = self.customers_validation(
+                self.csv_import(file=files['customers'], table='customers'))
+            self.customers_insert()
+
+            self.locators_df = self.locators_prepare(self.customers_df)
+            self.locators_insert()
+            self.rejected_counts = {
+                table: len(df)
+                for table, df in self.rejected.items()
+            }
+
+        self.migrate()
+
+        self.inventory = self.con.execute(
+            '''select value from Settings where name = \'inventory\''''
+        ).fetchone()[0]
+        if inventory not in (None, *self.inventory_modes):
+            self.close()
+            raise ValueError('Inventory must be one of %s' %
+                             ', '.join(self.inventory_modes))
+        if inventory == 'units' and self.inventory == 'ledger':
+            self.close()
+            raise ValueError('Database %s has ledger inventory already.' %
+                             self.database)
+        if inventory == 'ledger' and self.inventory == 'units':
+            self.inventory_migrate()
+
+        if concurrent:
+            self.writer = WriterThread(self.con)
+
+        if stats_interval:
+            self.stats_thread = threading.Thread(target=self.stats_run,
+                                                 args=(stats_interval, ),
+                                                 name='MarketStats',
+                                                 daemon=True)
+            self.stats_thread.start()
+
+    def connect(self, database, readonly=False):
+        """Open connection to database with self.pragmas applied."""
+
+        factory = sqlite3.Connection if self.metrics is None else TracedConnection
+        if readonly:
+            con = sqlite3.connect('file:%s?mode=ro' % database,
+                                  uri=True,
+                                  cached_statements=self.cached_statements,
+                                  check_same_thread=False,
+                                  factory=factory)
+        else:
+            con = sqlite3.connect(database,
+                                  cached_statements=self.cached_statements,
+                                  check_same_thread=False,
+                                  factory=factory)
+        if self.metrics is not None:
+            con.metrics = self.metrics
+            con.set_trace_callback(self.metrics.trace)
+        for pragma, value in self.pragmas.items():
+            if not (readonly and pragma == 'journal_mode'):
+                con.execute('PRAGMA %s = %s' % (pragma, value))
+        return con
+
+    def reader(self):
+        """
+        Return connection for read-only queries.
+        In concurrent mode each thread gets its own read-only connection, so reads
+        run in parallel with each other and with the writer thread.
+
+        """
+
+        if self.writer is None:
+            return self.con
+        con = getattr(self.readers, 'con', None)
+        if con is None:
+            con = self.connect(self.database, readonly=True)
+            self.readers.con = con
+            self.reader_cons.append(con)
+        return con
+
+    def write(self, function, *args, **kwargs):
+        """
+        Execute function, that writes into main database, and commit it.
+        Nested calls are committed by the outer one. In concurrent mode function is
+        executed by the writer thread. If function fails, its changes are rolled back.
+
+        """
+
+        if self.writer is not None and \
+                threading.current_thread() is not self.writer:
+            try:
+                return self.writer.submit(function,
+                                          *args,
+                                          timeout=self.write_timeout,
+                                          **kwargs)
+            except Exception as e:
+                print('An error occurred. Database wasn\'t updated.')
+                print('Error:', e)
+                return None
+            finally:
+                self.write_done()
+
+        if self.writing or self.writer is not None:
+            return function(*args, **kwargs)
+
+        self.writing = True
+        try:
+            result = function(*args, **kwargs)
+            self.con.commit()
+            return result
+        except Exception as e:
+            self.con.rollback()
+            print('An error occurred. Database wasn\'t updated.')
+            print('Error:', e)
+        finally:
+            self.writing = False
+            self.write_done()
+
+    def snapshot(self, target=None):
+        """
+        Copy main database by online backup API, e.g. to clone a populated database
+        for tests and benchmarks instead of import (see restore and snapshot argument).
+
+        Parameters
+        ----------
+            target : Path of database file or sqlite3 connection. Default: new database in memory
+
+        Returns
+        -------
+            Connection to the copy or path of the copy.
+
+        """
+
+        con = target
+        if target is None:
+            con = sqlite3.connect(':memory:', check_same_thread=False)
+        elif not isinstance(target, sqlite3.Connection):
+            con = sqlite3.connect(target)
+        try:
+            self.reader().backup(con)
+        finally:
+            if con is not target and target is not None:
+                con.close()
+        self.add_log(operation='snapshot', subject='database', data=str(target))
+        return con if target is None else target
+
+    def restore(self, source):
+        """
+        Replace main database by the copy (path or sqlite3 connection) by online backup API.
+        Writer thread is stopped for the time of copy. Caches are dropped and migrations
+        of the copy are applied. Raise ValueError, if the copy isn't a database of Market
+        (main database isn't changed in this case).
+
+        """
+
+        writer, self.writer = self.writer, None
+        if writer is not None:
+            writer.close()
+        try:
+            self.backup_from(source)
+        finally:
+            if writer is not None:
+                self.writer = WriterThread(self.con)
+        self.migrate()
+        self.inventory = self.con.execute(
+            '''select value from Settings where name = \'inventory\''''
+        ).fetchone()[0]
+        self.discounts = None
+        self.write_done()
+        self.add_log(operation='restore', subject='database', data=str(source))
+
+    def backup_from(self, source):
+        """
+        Copy database (path or sqlite3 connection) into main database by backup API.
+        Raise ValueError, if the copy hasn't tables of Market or its version is too new.
+
+        """
+
+        self.con.commit()
+        con = source if isinstance(source, sqlite3.Connection) \
+            else sqlite3.connect('file:%s?mode=ro' % source, uri=True)
+        try:
+            existing = {
+                row[0]
+                for row in con.execute(
+                    '''select name from sqlite_master where type = \'table\'''')
+            }
+            version = con.execute('''PRAGMA user_version''').fetchone()[0]
+            if not set(self.tables) <= existing or \
+                    version > self.migrations[-1][0]:
+                raise ValueError('%s isn\'t a database of Market' % source)
+            con.backup(self.con)
+        finally:
+            if con is not source:
+                con.close()
+
+    def stats(self):
+        """
+        Return statistics of Market: metrics of methods and statements with the trace
+        of the last statements (if Market is instrumented), audit log, discounts,
+        report cache and writer thread.
+
+        """
+
+        stats = {'methods': {}, 'statements': {}, 'trace': []}
+        if self.metrics is not None:
+            stats.update(self.metrics.stats(),
+                         trace=list(self.metrics.trace_log))
+        stats.update(
+            log=self.log.stats(),
+            discounts=self.discount_stats(),
+            reports=self.cache_stats(),
+            writer=None if self.writer is None else {
+                'calls': self.writer.calls,
+                'commits': self.writer.commits
+            })
+        return stats
+
+    def stats_dump(self):
+        """Write stats without trace into log_table as json."""
+
+        stats = self.stats()
+        del stats['trace']
+        self.add_log(operation='stats',
+                     subject='Market',
+                     data=json.dumps(stats, default=str))
+
+    def stats_run(self, interval):
+        while not self.stats_stop.wait(interval):
+            try:
+                self.stats_dump()
+            except Exception as e:
+                print('Stats weren\'t written. Error:', e)
+
+    def write_done(self):
+        """Count committed (or rolled back) write, so cached reports become stale."""
+
+        with self.reports_lock:
+            self.writes += 1
+
+    def watermark(self):
+        """
+        Return version of data in main database: number of writes of Market and
+        PRAGMA data_version, that is changed by commits of other connections and processes.
+        In concurrent mode data_version is read by its own connection, as main one is used
+        by the writer thread.
+
         """
 
-        self.database = self.dbname_check(name)
-        self.log_db = 'log_' + self.dbname_check(name)
-        self.db_create()
+        with self.reports_lock:
+            con = self.con
+            if self.writer is not None:
+                if self.version_con is None:
+                    self.version_con = self.connect(self.database,
+                                                    readonly=True)
+                    self.reader_cons.append(self.version_con)
+                con = self.version_con
+            return self.writes, con.execute(
+                '''PRAGMA data_version''').fetchone()[0]
+
+    def cached(self, function, *args, **kwargs):
+        """
+        Return result of function from LRU cache of reports, if it was computed
+        at the current watermark, otherwise call function and cache its result.
+        Cache keeps report_cache_size results, see cache_stats.
 
-        self.category_df = self.category_validation(
-            self.csv_import(file='categoris_table.csv', table='categories'))
-        self.category_insert()
+        """
 
-        self.goods_df = self.goods_validation(
-            self.csv_import(file='goods_table.csv', table='goods'))
-        self.goods_insert()
+        key = (function.__name__, repr(args[1:]), repr(sorted(kwargs.items())))
+        watermark = self.watermark()
+        with self.reports_lock:
+            if key in self.reports:
+                cached_watermark, result = self.reports[key]
+                if cached_watermark == watermark:
+                    self.reports.move_to_end(key)
+                    self.report_stats['hits'] += 1
+                    return result
+                self.report_stats['stale'] += 1
+            self.report_stats['misses'] += 1
+
+        result = function(*args, **kwargs)
+        with self.reports_lock:
+            self.reports[key] = (watermark, result)
+            self.reports.move_to_end(key)
+            while len(self.reports) > self.report_cache_size:
+                self.reports.popitem(last=False)
+                self.report_stats['evictions'] += 1
+        return result
+
+    def cache_stats(self):
+        """Return hits, misses (stale results are misses too), evictions and size of report cache."""
+
+        with self.reports_lock:
+            return dict(self.report_stats, size=len(self.reports),
+                        writes=self.writes)
+
+    def cache_clear(self):
+        """Drop all cached reports."""
+
+        with self.reports_lock:
+            self.reports.clear()
+
+    def close(self):
+        """Stop writer thread, flush log, commit and close all connections."""
+
+        if self.stats_thread is not None:
+            self.stats_stop.set()
+            self.stats_thread.join()
+            self.stats_thread = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.log.close()
+        for con in self.reader_cons:
+            con.close()
+        for con in (self.con, self.log_con):
+            con.commit()
+            con.close()
 
-        self.customers_df = self.customers_validation(
-            self.csv_import(file='Persons_table.csv', table='customers'))
-        self.customers_insert()
+    def __enter__(self):
+        return self
 
-        self.locators_df = self.customers_df[[
-            'first_name', 'last_name', 'email', 'additionalInfo'
-        ]][:]
-        self.locators_insert()
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def db_create(self):
         """Create all required Tables via SQL-query and logs it.
@@ -66,21 +1221,15 @@ class Market:
 
         """
 
-        con = sqlite3.connect(self.log_db)
+        con = self.log_con
         cursor = con.cursor()
         cursor.execute('''DROP TABLE IF EXISTS log_table''')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS log_table(
-                    id integer not null primary key autoincrement,
-                    dttm date default current_timestamp,
-                    operation nvarchar(255),
-                    subject nvarchar(255),
-                    data nvarchar(255)
-                    )''')
+        cursor.execute(self.log_table_sql)
         con.commit()
 
         self.add_log(operation='create', subject='log_table')
 
-        con = sqlite3.connect(self.database)
+        con = self.con
         cursor = con.cursor()
 
         cursor.execute('''DROP TABLE IF EXISTS Goods;''')
@@ -92,6 +1241,14 @@ class Market:
         cursor.execute('''DROP TABLE IF EXISTS Categories_sales;''')
         cursor.execute('''DROP TABLE IF EXISTS Customers_sales;''')
 
+        # Tables, created by migrations, are created again by migrate()
+        for table in [
+                row[0] for row in cursor.execute(
+                    '''select name from sqlite_master where type = \'table\'
+                       and name not like \'sqlite%\'''')
+        ]:
+            cursor.execute('''DROP TABLE IF EXISTS %s''' % table)
+
         # Creating Goods table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS Goods(
@@ -211,338 +1368,1207 @@ class Market:
 
         self.add_log(operation='create', subject='Customers_sales')
 
+        # New tables haven't got any migrations yet
+        cursor.execute('''PRAGMA user_version = 0''')
         con.commit()
+        self.write_done()
 
-    def csv_import(self, file='categoris_table.csv', table=None):
-        """Import original data from csv to database"""
+    def schema_exists(self):
+        """
+        Check, whether all tables of Market exist in the database and its version is supported.
+        Raise ValueError, if only a part of tables exists or the database is newer than migrations.
 
-        raw_df = pd.read_csv(file, sep='\n', names=['chunk'])
-        imported_df = raw_df
-        if table == 'categories':
-            imported_df = self.import_converting(
-                raw_df, 3, ['id', 'title', 'description'])
-        if table == 'goods':
-            imported_df = self.import_converting(
-                raw_df, 4, ['id', 'title', 'price', 'categoryId'])
-        if table == 'customers':
-            imported_df = self.import_converting(
-                raw_df, 5,
-                ['id', 'first_name', 'last_name', 'email', 'gender'])
-        return imported_df
+        """
 
-    def table_size(self, db_name):
-        """Take database's name and print number of rows. """
+        existing = {
+            row[0]
+            for row in self.con.execute(
+                '''select name from sqlite_master where type = \'table\'''')
+        }
+        missing = [table for table in self.tables if table not in existing]
+        if len(missing) == len(self.tables):
+            return False
+        if missing:
+            raise ValueError(
+                'Database %s has no tables %s. Use rebuild=True to create it again.'
+                % (self.database, ', '.join(missing)))
+
+        version = self.con.execute('''PRAGMA user_version''').fetchone()[0]
+        if version > self.migrations[-1][0]:
+            raise ValueError(
+                'Version of database %s is %s, supported versions are up to %s.'
+                % (self.database, version, self.migrations[-1][0]))
+        return True
+
+    def migrate(self):
+        """
+        Apply migrations, that are newer than the version of database, without dropping data.
+        Each migration is applied in its own transaction. Return version of database.
+
+        """
 
-        con = sqlite3.connect(self.database)
+        con = self.con
         cursor = con.cursor()
-        rows = cursor.execute('''SELECT COUNT(*) FROM %s''' %
-                              db_name).fetchone()[0]
-        print('Table', db_name, 'contains %s rows' % rows)
-        con.commit()
+        version = cursor.execute('''PRAGMA user_version''').fetchone()[0]
+        for number, description, statements in self.migrations:
+            if number <= version:
+                continue
+            cursor.execute('''BEGIN''')
+            try:
+                for sql in statements:
+                    cursor.execute(sql)
+                cursor.execute('''PRAGMA user_version = %d''' % number)
+                con.commit()
+                self.write_done()
+            except Exception:
+                con.rollback()
+                raise
+            self.add_log(operation='migrate',
+                         subject='schema',
+                         data='%s: %s' % (number, description))
+            version = number
+        return version
+
+    def query_plan(self, sql, params=()):
+        """Return details of EXPLAIN QUERY PLAN of the query."""
+
+        return [
+            row[-1] for row in self.reader().execute(
+                '''EXPLAIN QUERY PLAN ''' + sql, params)
+        ]
+
+    def check_query_plans(self):
+        """
+        Check, that no hot query scans the whole table (see plan_scans).
+        Raise RuntimeError with the plan of the first query with a full scan.
+        Return dict of plans by name of query.
 
-        return 0
+        """
+
+        plans = {}
+        for name, (sql, params) in self.hot_queries.items():
+            plans[name] = self.query_plan(sql, params)
+            if self.plan_scans(plans[name]):
+                raise RuntimeError('Query %s scans the table: %s' %
+                                   (name, plans[name]))
+        return plans
+
+    @staticmethod
+    def plan_scans(plan):
+        """
+        Return steps of query plan (see query_plan), that scan a whole table.
+        Scans of subqueries, that are computed by the query itself, are allowed.
 
-    def db_print(self, table_name, limit=30):
         """
-        Take table's name and print rows from it.
+
+        subqueries = {
+            detail.split(' ', 1)[1]
+            for detail in plan
+            if detail.startswith(('CO-ROUTINE ', 'MATERIALIZE '))
+        }
+        return [
+            detail for detail in plan if detail.startswith('SCAN')
+            and detail[5:].replace(' LEFT-JOIN', '') not in subqueries
+        ]
+
+    def csv_import(self, file='categoris_table.csv', table=None, chunksize=None):
+        """
+        Import original data from csv file and split it into columns of the table.
 
         Parameters
         ----------
-            limit : Number of rows
+            file : Path to csv file or text file-like object
 
-            table_name : Name of table from database
+            table : One of import_layouts keys. If not set, raw lines are returned.
 
-        """
+            chunksize : If set, generator of dataframes with at most chunksize rows
+                        is returned instead of one dataframe. File is read lazily.
 
-        con = sqlite3.connect(self.database)
-        cursor = con.cursor()
-        for i in cursor.execute('''SELECT * FROM %s LIMIT %s''' %
-                                (table_name, limit)):
-            print(i)
-        con.commit()
-        return 0
+        """
 
-    def goods_cats(self, limit=30):
-        """Print join of 'Goods' and 'Categories' tables"""
-        con = sqlite3.connect(self.database)
-        cursor = con.cursor()
-        for i in cursor.execute(
-                '''SELECT Goods.title, Goods.price, Categories.title, Categories.description
-                                    FROM Goods
-                                    LEFT JOIN Categories
-                                    ON Goods.categoryId = Categories.id'''):
-            print(i)
-        con.commit()
-        return 0
+        if chunksize:
+            return self._csv_import_chunks(file, table, chunksize)
 
-    def sql_execution(self, sql_query):
-        """Execute SQL query in main database"""
+        return next(self._csv_import_chunks(file, table, None))
 
-        con = sqlite3.connect(self.database)
-        cursor = con.cursor()
-        for i in cursor.execute(sql_query).fetchall():
-            print(i)
-        con.commit()
+    def _csv_import_chunks(self, file, table, chunksize):
+        """
+        Generator of converted chunks. Malformed lines are collected in self.malformed
+        (at most sample_size of them in streaming mode) when the file is read.
 
-    def category_insert(self):
-        """Insert validated data from dataframe into table Categories."""
+        """
 
-        con = sqlite3.connect(self.database)
-        cursor = con.cursor()
+        malformed_chunks = []
+        self.malformed_counts[table] = 0
         try:
-            for index, rows in self.category_df.iterrows():
-                sql = '''insert into Categories(id,title,description) values(?, ?, ?);'''
-                data = (rows.id, rows.title, rows.description)
-                cursor.execute(sql, data)
-                con.commit()
-                self.add_log(operation='insert',
-                             subject='Categories',
-                             data=str(data))
-        except Exception as e:
-            print('An error occurred. Database wasn\'t updated.')
-            print('Error:', e)
-
-    def goods_insert(self):
-        """Insert validated data from dataframe into table Goods."""
+            for raw_df in self.csv_read(file, chunksize):
+                imported_df = raw_df
+                malformed_df = raw_df[:0]
+                if table in self.import_layouts:
+                    columns_list = self.import_layouts[table]
+                    imported_df, malformed_df = self.import_converting(
+                        raw_df, len(columns_list), columns_list)
+                if len(malformed_df) > 0:
+                    print('Table:', table, len(malformed_df),
+                          'malformed rows were skipped.')
+                self.malformed_counts[table] += len(malformed_df)
+                if chunksize:
+                    self.sample_add(malformed_chunks, malformed_df)
+                else:
+                    self.malformed[table] = malformed_df
+                yield imported_df
+        finally:
+            if malformed_chunks:
+                self.malformed[table] = pd.concat(malformed_chunks)
 
-        con = sqlite3.connect(self.database)
-        cursor = con.cursor()
-        try:
-            for index, rows in self.goods_df.iterrows():
-                sql = '''insert into Goods(id,title,price,categoryId) values(?, ?, ?, ?);'''
-                data = (rows.id, rows.title, rows.price, rows.categoryId)
-                cursor.execute(sql, data)
-                con.commit()
-                self.add_log(operation='insert',
-                             subject='Goods',
-                             data=str(data))
-        except Exception as e:
-            print('An error occurred. Database wasn\'t updated.')
-            print('Error:', e)
+    def import_stream(self, file, table, chunksize=50000):
+        """
+        Import csv file into database chunk by chunk.
+        Chunks flow through converting, validation and insertion one after another,
+        so memory consumption depends on chunksize and not on the size of the file.
+        First rows are inserted before the file is read completely.
 
-    def customers_insert(self):
-        """Insert validated data from dataframe into table Customers."""
+        Parameters
+        ----------
+            file : Path to csv file
 
-        con = sqlite3.connect(self.database)
-        cursor = con.cursor()
-        try:
-            for index, rows in self.customers_df[[
-                    'id', 'first_name', 'last_name', 'gender'
-            ]].iterrows():
-                sql = '''insert into Customers(id,first_name,last_name,gender) values(?, ?, ?, ?);'''
-                data = (rows.id, rows.first_name, rows.last_name, rows.gender)
-                cursor.execute(sql, data)
-                con.commit()
-                self.add_log(operation='insert',
-                             subject='Customers',
-                             data=str(data))
-        except Exception as e:
-            print('An error occurred. Database wasn\'t updated.')
-            print('Error:', e)
+            table : categories, goods or customers (customers also fill Locators)
 
-    def locators_insert(self):
-        """Insert validated data from dataframe into table Locators."""
+            chunksize : Max number of rows in one chunk
 
-        con = sqlite3.connect(self.database)
-        cursor = con.cursor()
-        try:
-            for index, rows in self.locators_df.iterrows():
-                sql = '''SELECT count(*) FROM (SELECT 1 FROM Locators WHERE first_name = ? AND last_name = ?) t1'''
-                data = (rows.first_name, rows.last_name)
-                if cursor.execute(sql, data).fetchone()[0] == 0:
-                    sql = '''insert into Locators(first_name, last_name, email, additionalInfo) values(?,?,?,?)'''
-                    data = (rows.first_name, rows.last_name, rows.email,
-                            rows.additionalInfo)
-                    cursor.execute(sql, data)
-                    con.commit()
-                    self.add_log(operation='insert',
-                                 subject='Locators',
-                                 data=str(data))
-                else:
-                    sql = '''update Locators set additionalInfo = additionalInfo || ? || ? || '; '
-                    where first_name=? and last_name=?'''
-                    data = (rows.email, rows.additionalInfo, rows.first_name,
-                            rows.last_name)
-                    cursor.execute(sql, data)
-                    con.commit()
-                    self.add_log(operation='update',
-                                 subject='Locators',
-                                 data=str(data))
-        except Exception as e:
-            print('An error occurred. Database wasn\'t updated.')
-            print('Error:', e)
-        con.commit()
+        Returns number of inserted rows. Rejected and malformed rows are counted, only
+        the first sample_size of them are kept in rejected and malformed.
 
-    def delivery_add(self,
-                     title,
-                     price,
-                     category_id=0,
-                     quantity=1,
-                     additionalInfo=None):
         """
-        Adds delivery as transaction + warehouse replenishment.
-        Delivery must contain only one article's type.
 
+        validation = self.validation(table)
+        chunks = self.csv_import(file=file, table=table, chunksize=chunksize)
+        validated_chunks = (validation(chunk) for chunk in chunks)
+
+        rows = 0
+        rejected_chunks = []
+        self.rejected_counts[table] = 0
+        for df, rejected_df in validated_chunks:
+            self.rejected_counts[table] += len(rejected_df)
+            self.sample_add(rejected_chunks, rejected_df)
+            self.chunk_insert(table, df)
+            rows += len(df)
+        if rejected_chunks:
+            self.rejected[table] = pd.concat(rejected_chunks)
+        return rows
+
+    def sample_add(self, chunks, df):
+        """Append rows of df to the list of chunks, while there are less than sample_size rows in them."""
+
+        kept = sum(len(chunk) for chunk in chunks)
+        if kept < self.sample_size:
+            chunks.append(df[:self.sample_size - kept])
+
+    def parallel_import(self, files, chunksize=None, workers=None):
         """
+        Import csv files, converting and validating them on a process pool.
+        Files (and chunks of files, if chunksize is set) are prepared in parallel,
+        results are inserted into database in order of files. At most 2 * workers chunks
+        are read and submitted ahead of the inserted one, so memory depends on chunksize
+        and not on the size of files.
 
-        con = sqlite3.connect(self.database)
-        cursor = con.cursor()
-        sql = '''insert into Deliveries(title, category_id, quantity, price, additionalInfo) values(?,?,?,?,?)'''
-        data = (title, category_id, quantity, price, additionalInfo)
-        cursor.execute(sql, data)
-        con.commit()
-        self.add_log(operation='insert', subject='Deliveries', data=str(data))
-        self.goods_add(title, price, category_id, quantity)
-        self.transactions_add(type='delivery',
-                              subject_id=-1,
-                              quantity=quantity,
-                              total=quantity * price,
-                              additionalInfo=additionalInfo)
-        print('Record successfully added.')
+        Parameters
+        ----------
+            files : List of (file, table) in order of insertion
 
-    def goods_add(self, title, price, categoryId=0, count=0, delflg=0):
-        """Add new goods into database. Each row contain only 1 unit of goods"""
+            chunksize : If set, files are split into chunks of this size and
+                        dataframes category_df, goods_df, customers_df, locators_df are not kept.
+                        Only the first sample_size rejected and malformed rows are kept.
 
-        con = sqlite3.connect(self.database)
-        cursor = con.cursor()
-        sql = '''insert into Goods(title, price, categoryId, delflg) values(?,?,?,?)'''
-        for i in range(0, count):
-            data = (title, price, categoryId, delflg)
-            cursor.execute(sql, data)
-            self.add_log(operation='insert', subject='Goods', data=str(data))
+            workers : Number of processes. Default: number of CPUs
 
-        con.commit()
+        Returns number of inserted rows.
 
-    def transactions_add(self,
-                         type,
-                         subject_id,
-                         total=0,
-                         quantity=1,
-                         customer_id=None,
-                         discount=0,
-                         additionalInfo=None,
-                         date=pd.datetime.now().date()):
         """
-        Add new transaction into database. Transaction's type may be different.
-        If type = return or sell, subject_id is good_id, in case of delivery - supplier_id
-        delivery gets '-1' as subject_id by default, but it must be another one table 'Suppliers'.
+
+        rows = 0
+        in_flight = 2 * (workers or os.cpu_count() or 1)
+        results = {table: ([], [], []) for _, table in files}
+        for _, table in files:
+            self.rejected_counts[table] = self.malformed_counts[table] = 0
+
+        def chunks():
+            for file, table in files:
+                for raw_df in self.csv_read(file, chunksize):
+                    yield table, raw_df
+
+        def chunk_done(table, future):
+            nonlocal rows
+            df, rejected_df, malformed_df = future.result()
+            self.chunk_insert(table, df)
+            rows += len(df)
+            accepted_chunks, rejected_chunks, malformed_chunks = results[table]
+            self.rejected_counts[table] += len(rejected_df)
+            self.malformed_counts[table] += len(malformed_df)
+            if chunksize:
+                self.sample_add(rejected_chunks, rejected_df)
+                self.sample_add(malformed_chunks, malformed_df)
+            else:
+                accepted_chunks.append(df)
+                rejected_chunks.append(rejected_df)
+                malformed_chunks.append(malformed_df)
+
+        with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = collections.deque()
+            for table, raw_df in chunks():
+                pending.append((table,
+                                executor.submit(Market.prepare_chunk, table,
+                                                raw_df)))
+                if len(pending) >= in_flight:
+                    chunk_done(*pending.popleft())
+            while pending:
+                chunk_done(*pending.popleft())
+
+        for table, (accepted_chunks, rejected_chunks,
+                    malformed_chunks) in results.items():
+            self.rejected[table] = pd.concat(rejected_chunks)
+            self.malformed[table] = pd.concat(malformed_chunks)
+
+            df = pd.concat(accepted_chunks) if accepted_chunks else None
+            if table == 'categories':
+                self.category_df = df
+            if table == 'goods':
+                self.goods_df = df
+            if table == 'customers':
+                self.customers_df = df
+                self.locators_df = None if df is None \
+                    else self.locators_prepare(df)
+        return rows
+
+    def chunk_insert(self, table, df):
+        """Insert validated dataframe of source table (categories, goods or customers) into database."""
+
+        if table == 'categories':
+            self.category_insert(df)
+        if table == 'goods':
+            self.goods_insert(df)
+        if table == 'customers':
+            self.customers_insert(df)
+            self.locators_insert(self.locators_prepare(df))
+
+    def table_size(self, db_name):
+        """Take database's name and print number of rows. """
+
+        rows = self.table_count(db_name)
+        print('Table', db_name, 'contains %s rows' % rows)
+
+        return 0
+
+    @cached_report
+    def table_count(self, table_name):
+        """Return number of rows in the table."""
+
+        con = self.reader()
+        cursor = con.cursor()
+        rows = cursor.execute('''SELECT COUNT(*) FROM "%s"''' %
+                              self.table_check(table_name)).fetchone()[0]
+        con.commit()
+        return rows
+
+    def table_check(self, table_name):
+        """Return table_name, if there is such table in main database. Raise ValueError otherwise."""
+
+        if self.reader().execute(
+                '''select 1 from sqlite_master where type = \'table\' and name = ?''',
+            [table_name]).fetchone() is None:
+            raise ValueError('There is no table %r in database %s' %
+                             (table_name, self.database))
+        return table_name
+
+    def query(self, sql, params=(), batch_size=None, as_frame=False):
+        """
+        Execute read-only query and yield its rows. Rows are fetched by batches, so
+        results of any size are read in constant memory.
+
+        Parameters
+        ----------
+            params : Parameters of the query
+
+            batch_size : Number of rows, fetched at once. Default: read_batch_size
+
+            as_frame : If True, dataframes of batch_size rows are yielded instead of rows
+
+        """
+
+        con = self.reader()
+        cursor = con.cursor()
+        cursor.execute(sql, params)
+        columns = [column[0] for column in cursor.description]
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size or self.read_batch_size)
+                if not rows:
+                    break
+                if as_frame:
+                    yield pd.DataFrame(rows, columns=columns)
+                else:
+                    yield from rows
+        finally:
+            cursor.close()
+            con.commit()
+
+    def table_rows(self,
+                   table_name,
+                   after=None,
+                   limit=None,
+                   key=None,
+                   batch_size=None,
+                   as_frame=False):
+        """
+        Yield rows of the table in order of key (see query). Pages are read by keyset:
+        the next page starts after the key of the last row, so no rows are skipped by OFFSET.
+
+        Parameters
+        ----------
+            table_name : Name of table from database
+
+            after : Rows with key greater than after are read. Default: from the first row
+                    If key has several columns, after is a tuple of values of its first
+                    columns or a value of the first column.
+
+            limit : Number of rows. Default: all rows
+
+            key : Unique column or list of columns, rows are ordered by. Default: rowid
+                  (for tables with integer id rowid is id), or primary key of tables
+                  WITHOUT ROWID, e.g. (date, type) of Revenue_daily.
+
+        """
+
+        self.table_check(table_name)
+        con = self.reader()
+        info = list(con.execute('''PRAGMA table_info("%s")''' % table_name))
+        columns = [row[1] for row in info]
+        table_sql = con.execute(
+            '''select sql from sqlite_master where type = \'table\' and name = ?''',
+            [table_name]).fetchone()[0]
+        rowid = re.search(r'WITHOUT\s+ROWID\s*$', table_sql, re.I) is None
+        if key is None:
+            key = 'rowid' if rowid else [
+                row[1] for row in sorted(info, key=lambda row: row[5])
+                if row[5]
+            ]
+        keys = [key] if isinstance(key, str) else list(key)
+        for column in keys:
+            if column == 'rowid' and not rowid:
+                raise ValueError('Table %s has no rowid' % table_name)
+            if column != 'rowid' and column not in columns:
+                raise ValueError('There is no column %r in table %s' %
+                                 (column, table_name))
+
+        sql = '''SELECT * FROM "%s"''' % table_name
+        params = []
+        if after is not None:
+            after = list(after) if isinstance(after, (list, tuple)) else [after]
+            sql += ''' WHERE (%s) > (%s)''' % (', '.join(
+                '"%s"' % column
+                for column in keys[:len(after)]), ','.join('?' * len(after)))
+            params += after
+        sql += ''' ORDER BY %s''' % ', '.join('"%s"' % column
+                                          for column in keys)
+        if limit is not None:
+            sql += ''' LIMIT ?'''
+            params.append(limit)
+        return self.query(sql, params, batch_size, as_frame)
+
+    def db_print(self, table_name, limit=30, after=None):
+        """
+        Take table's name, print rows from it and return them.
+
+        Parameters
+        ----------
+            limit : Number of rows
+
+            table_name : Name of table from database
+
+            after : Print rows after this key, see table_rows
+
+        """
+
+        rows = list(self.table_rows(table_name, after=after, limit=limit))
+        for i in rows:
+            print(i)
+        return rows
+
+    def goods_cats_rows(self, after=None, limit=None, batch_size=None,
+                        as_frame=False):
+        """Yield join of 'Goods' and 'Categories' tables in order of good's id (see table_rows)."""
+
+        sql = '''SELECT Goods.id, Goods.title, Goods.price, Categories.title, Categories.description
+                 FROM Goods
+                 LEFT JOIN Categories
+                 ON Goods.categoryId = Categories.id
+                 WHERE Goods.id > ?
+                 ORDER BY Goods.id
+                 LIMIT ?'''
+        return self.query(sql, [-1 if after is None else after,
+                                -1 if limit is None else limit], batch_size,
+                          as_frame)
+
+    def goods_cats(self, limit=30, after=None):
+        """Print join of 'Goods' and 'Categories' tables and return printed rows"""
+
+        rows = list(self.goods_cats_rows(after=after, limit=limit))
+        for i in rows:
+            print(i)
+        return rows
+
+    @write_operation
+    def sql_execution(self, sql_query, batch_size=None):
+        """
+        Execute SQL query in main database, print rows of its result by batches
+        and return number of them. Use query to read large results without printing.
+
+        """
+
+        con = self.con
+        cursor = con.cursor()
+        cursor.execute(sql_query)
+        count = 0
+        while True:
+            rows = cursor.fetchmany(batch_size or self.read_batch_size)
+            if not rows:
+                break
+            for i in rows:
+                print(i)
+            count += len(rows)
+        return count
+
+    def category_insert(self, df=None, batch_size=None):
+        """Insert validated data from dataframe (self.category_df as default) into table Categories."""
+
+        if df is None:
+            df = self.category_df
+        return self.bulk_insert('Categories', df,
+                                ['id', 'title', 'description'], batch_size)
+
+    def goods_insert(self, df=None, batch_size=None):
+        """Insert validated data from dataframe (self.goods_df as default) into table Goods."""
+
+        if df is None:
+            df = self.goods_df
+        return self.bulk_insert('Goods', df,
+                                ['id', 'title', 'price', 'categoryId'],
+                                batch_size)
+
+    def customers_insert(self, df=None, batch_size=None):
+        """Insert validated data from dataframe (self.customers_df as default) into table Customers."""
+
+        if df is None:
+            df = self.customers_df
+        return self.bulk_insert('Customers', df,
+                                ['id', 'first_name', 'last_name', 'gender'],
+                                batch_size)
+
+    def bulk_insert(self, table, df, columns, batch_size=None):
+        """
+        Insert columns of dataframe into table via executemany by batches (see batch_execute).
+
+        Parameters
+        ----------
+            table : Name of table from database
+
+            df : Dataframe with validated data
+
+            columns : Columns of dataframe and table to insert
+
+            batch_size : Number of rows in one transaction. Default: self.batch_size
+
+        Returns number of inserted rows.
+
+        """
+
+        sql = 'insert into %s(%s) values(%s)' % (table, ','.join(columns),
+                                                 ','.join('?' * len(columns)))
+        rows = list(zip(*[df[column].tolist() for column in columns]))
+        return self.batch_execute(table, sql, rows, batch_size)
+
+    def batch_execute(self,
+                      table,
+                      sql,
+                      rows,
+                      batch_size=None,
+                      operation='insert'):
+        """
+        Execute sql for each of rows via executemany by batches of batch_size rows
+        (self.batch_size as default). Each batch and its log entries are committed once,
+        cached reports become stale after each batch (see write_done).
+        In concurrent mode each batch is a call of the writer thread, so bulk loads
+        are committed between writes of other threads.
+        If a batch fails, it is rolled back and the rest of rows isn't executed.
+
+        Returns number of executed rows.
+
+        """
+
+        batch_size = batch_size or self.batch_size
+        con = self.con
+        concurrent = self.writer is not None
+        executed = 0
+        started = time.perf_counter()
+        try:
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                if concurrent:
+                    try:
+                        self.writer.submit(con.executemany,
+                                           sql,
+                                           batch,
+                                           timeout=self.write_timeout)
+                    finally:
+                        self.write_done()
+                else:
+                    con.executemany(sql, batch)
+                    con.commit()
+                    self.write_done()
+                self.add_logs([(operation, table, str(data))
+                               for data in batch])
+                executed += len(batch)
+        except Exception as e:
+            if not concurrent:
+                con.rollback()
+            print('An error occurred. Database wasn\'t updated.')
+            print('Error:', e)
+
+        elapsed = time.perf_counter() - started
+        print('Table: %s. %s rows (%s), %.0f rows/s' %
+              (table, executed, operation,
+               executed / elapsed if elapsed else 0))
+        return executed
+
+    def locators_insert(self, df=None, batch_size=None):
+        """
+        Merge validated data from dataframe (self.locators_df as default) into table Locators.
+        Rows are grouped by (first_name, last_name): the first row of a person gives email,
+        email and info of the next rows are appended to additionalInfo. If the person
+        is already in the table, email and info of all rows are appended.
+
+        Returns number of merged persons.
 
         """
+
+        if df is None:
+            df = self.locators_df
+        keys = [df['first_name'], df['last_name']]
+        info = df['email'] + df['additionalInfo'] + '; '
+        first = ~df.duplicated(['first_name', 'last_name'])
+
+        merged_df = df[first].set_index(['first_name', 'last_name'])
+        tail_info = info[~first].groupby([key[~first] for key in keys],
+                                         sort=False).agg(''.join)
+        all_info = info.groupby(keys, sort=False).agg(''.join)
+        merged_df['additionalInfo'] += tail_info.reindex(merged_df.index,
+                                                         fill_value='')
+        merged_df['conflict_info'] = all_info.reindex(merged_df.index)
+        merged_df.reset_index(inplace=True)
+
+        sql = '''insert into Locators(first_name, last_name, email, additionalInfo) values(?,?,?,?)
+                on conflict(first_name, last_name) do update set additionalInfo = additionalInfo || ?'''
+        rows = list(
+            zip(*[
+                merged_df[column].tolist()
+                for column in ['first_name', 'last_name', 'email',
+                               'additionalInfo', 'conflict_info']
+            ]))
+        return self.batch_execute('Locators', sql, rows, batch_size,
+                                  operation='upsert')
+
+    @write_operation
+    def delivery_add(self,
+                     title,
+                     price,
+                     category_id=0,
+                     quantity=1,
+                     additionalInfo=None):
+        """
+        Adds delivery as transaction + warehouse replenishment.
+        Delivery must contain only one article's type.
+
+        """
+
+        con = self.con
+        cursor = con.cursor()
+        sql = '''insert into Deliveries(title, category_id, quantity, price, additionalInfo) values(?,?,?,?,?)'''
+        data = (title, category_id, quantity, price, additionalInfo)
+        cursor.execute(sql, data)
+        self.add_log(operation='insert', subject='Deliveries', data=str(data))
+        self.goods_add(title, price, category_id, quantity)
+        self.transactions_add(type='delivery',
+                              subject_id=-1,
+                              quantity=quantity,
+                              total=quantity * price,
+                              additionalInfo=additionalInfo)
+        print('Record successfully added.')
+
+    @write_operation
+    def deliveries_import(self, manifest):
+        """
+        Add all deliveries of manifest in one transaction. Deliveries, goods (or Stock in
+        'ledger' inventory) and transactions are inserted by executemany, instead of
+        several statements and commits per delivery and a row per unit in delivery_add.
+
+        Parameters
+        ----------
+            manifest : Dataframe or csv file (path or text file-like object) with columns
+                       title, price, quantity and optional category_id, additionalInfo.
+
+        Returns
+        -------
+            Dataframe of manifest lines with 'status' - delivered or rejected, 'reason' -
+            failed columns of rejected lines (see rules_validation) and 'delivery_id'.
+
+        """
+
+        df = self.manifest_prepare(manifest)
+        accepted_df, rejected_df = self.rules_validation(df,
+                                                         self.manifest_rules)
+
+        lines = list(
+            zip(accepted_df['title'], pd.to_numeric(accepted_df['price']),
+                pd.to_numeric(accepted_df['category_id']).astype(int),
+                pd.to_numeric(accepted_df['quantity']).astype(int),
+                accepted_df['additionalInfo']))
+        date = datetime.date.today()
+        cursor = self.con.cursor()
+
+        deliveries = [(title, category_id, quantity, price, info)
+                      for title, price, category_id, quantity, info in lines]
+        cursor.executemany(
+            '''insert into Deliveries(title, category_id, quantity, price, additionalInfo) values(?,?,?,?,?)''',
+            deliveries)
+        # Ids of deliveries, inserted by this writer in one transaction, are consecutive
+        last_id = cursor.execute(
+            '''select max(id) from Deliveries''').fetchone()[0] or 0
+
+        if self.inventory == 'ledger':
+            self.stock_deliver(cursor, lines, date)
+        else:
+            cursor.executemany(
+                '''insert into Goods(title, price, categoryId, delflg) values(?,?,?,0)''',
+                ((title, price, category_id)
+                 for title, price, category_id, quantity, _ in lines
+                 for _ in range(quantity)))
+
+        transactions = [('delivery', quantity * price, -1, quantity, None, 0,
+                         info, date)
+                        for title, price, category_id, quantity, info in lines]
+        cursor.executemany(self.sell_insert_sql, transactions)
+        self.rollups_add(cursor, [('delivery', item[1], None, date)
+                                  for item in transactions])
+
+        self.add_logs([('insert', 'Deliveries', str(item)) for item in deliveries] +
+                      [('insert', 'Stock' if self.inventory == 'ledger' else
+                        'Goods', str(line[:4])) for line in lines] +
+                      [('insert', 'Transactions', str(item))
+                       for item in transactions])
+
+        accepted_df = accepted_df.assign(status='delivered',
+                                         reason='',
+                                         delivery_id=range(
+                                             last_id - len(lines) + 1,
+                                             last_id + 1))
+        rejected_df = rejected_df.assign(status='rejected', delivery_id=None)
+        print('Deliveries:', len(accepted_df), 'lines delivered,',
+              len(rejected_df), 'lines rejected.')
+        return pd.concat([accepted_df, rejected_df]).sort_index()
+
+    def manifest_prepare(self, manifest):
+        """Return dataframe of manifest (dataframe or csv file) with string columns of manifest_columns."""
+
+        if isinstance(manifest, pd.DataFrame):
+            df = manifest.copy()
+        else:
+            df = pd.read_csv(manifest, dtype=str, keep_default_na=False)
+        missing = [
+            column for column in ['title', 'price', 'quantity']
+            if column not in df.columns
+        ]
+        if missing:
+            raise ValueError('Manifest has no columns %s' % ', '.join(missing))
+        if 'category_id' not in df.columns:
+            df['category_id'] = 0
+        if 'additionalInfo' not in df.columns:
+            df['additionalInfo'] = None
+        df = df[self.manifest_columns]
+        df['category_id'] = df['category_id'].where(
+            df['category_id'].notna() & (df['category_id'] != ''), 0)
+        df['additionalInfo'] = df['additionalInfo'].where(
+            df['additionalInfo'].notna() & (df['additionalInfo'] != ''), None)
+        return df
+
+    def stock_deliver(self, cursor, lines, date):
+        """Add quantities of lines (title, price, category_id, quantity, info) to Stock with movements."""
+
+        cursor.executemany(
+            '''insert into Stock(title, price, categoryId, quantity) values(?,?,?,?)
+               on conflict(title, price, categoryId)
+               do update set quantity = quantity + excluded.quantity''',
+            [line[:4] for line in lines])
+
+        titles = list({line[0] for line in lines})
+        stock_ids = {}
+        for start in range(0, len(titles), 500):
+            chunk = titles[start:start + 500]
+            for stock_id, title, price, category_id in cursor.execute(
+                    self.stock_titles_sql % ','.join('?' * len(chunk)), chunk):
+                stock_ids[(title, price, category_id)] = stock_id
+        cursor.executemany(self.movement_insert_sql,
+                           [(stock_ids[line[:3]], 'delivery', line[3], None,
+                             date) for line in lines])
+
+    @write_operation
+    def goods_add(self, title, price, categoryId=0, count=0, delflg=0):
+        """
+        Add new goods into database. In 'units' inventory each row of Goods contain only
+        1 unit of goods. In 'ledger' inventory quantity of the article in Stock is increased
+        by count and the delivery is recorded in Stock_movements. Ledger has no sold units,
+        so delflg raises ValueError there.
+
+        """
+
+        con = self.con
+        cursor = con.cursor()
+        if self.inventory == 'ledger':
+            if delflg:
+                raise ValueError(
+                    'Sold goods can\'t be added to ledger inventory')
+            self.quantity_check(count)
+            sql = '''insert into Stock(title, price, categoryId, quantity) values(?,?,?,?)
+                     on conflict(title, price, categoryId)
+                     do update set quantity = quantity + excluded.quantity'''
+            data = (title, price, categoryId, count)
+            cursor.execute(sql, data)
+            stock_id = cursor.execute(self.stock_article_sql,
+                                      [title, price, categoryId]).fetchone()[0]
+            cursor.execute(self.movement_insert_sql,
+                           [stock_id, 'delivery', count, None,
+                            datetime.date.today()])
+            self.add_log(operation='upsert', subject='Stock', data=str(data))
+            return stock_id
+
+        sql = '''insert into Goods(title, price, categoryId, delflg) values(?,?,?,?)'''
+        data = [(title, price, categoryId, delflg)] * count
+        cursor.executemany(sql, data)
+        self.add_logs([('insert', 'Goods', str(item)) for item in data])
+
+    @write_operation
+    def transactions_add(self,
+                         type,
+                         subject_id,
+                         total=0,
+                         quantity=1,
+                         customer_id=None,
+                         discount=0,
+                         additionalInfo=None,
+                         date=None):
+        """
+        Add new transaction into database. Transaction's type may be different.
+        If type = return or sell, subject_id is good_id, in case of delivery - supplier_id
+        delivery gets '-1' as subject_id by default, but it must be another one table 'Suppliers'.
+        In 'ledger' inventory subject_id of sell and return is id of Stock and quantity
+        of units may be more than 1, it must be a positive integer (see quantity_check).
+        Date of transaction is today as default.
+
+        """
+
+        if date is None:
+            date = datetime.date.today()
         if not (type == 'delivery' or type == 'return' or type == 'sell'):
             print('Error: incorrect type. Must be delivery, return or sell.')
 
+        elif type == 'sell' and self.inventory == 'ledger':
+            self.quantity_check(quantity)
+            cursor = self.con.cursor()
+
+            # Claim quantity of the article, see stock_claim_sql
+            if cursor.execute(self.stock_claim_sql,
+                              [quantity, subject_id, quantity]).rowcount == 0:
+                print('There are no goods at the warehouse')
+            else:
+                self.add_log(operation='update',
+                             subject='Stock',
+                             data=str((subject_id, -quantity)))
+
+                _, price, discount, _ = self.sell_prices(cursor, [subject_id],
+                                                         customer_id)[0]
+                data = (type, round(price * (1 - discount) * quantity, 2),
+                        subject_id, quantity, customer_id, discount,
+                        additionalInfo, date)
+                cursor.execute(self.sell_insert_sql, data)
+                cursor.execute(self.movement_insert_sql,
+                               [subject_id, type, -quantity,
+                                cursor.lastrowid, date])
+                self.rollups_add(cursor, [(type, data[1], customer_id, date)])
+                self.add_log(operation='insert',
+                             subject='Transactions',
+                             data=str(data))
+
         elif type == 'sell':
             quantity = 1
-            con = sqlite3.connect(self.database)
+            con = self.con
             cursor = con.cursor()
 
-            if (cursor.execute(
-                    '''select count(*)
-                                    from Goods
-                                    where Goods.id = ? and Goods.delflg = 0''',
-                [subject_id]).fetchone()[0]) == 0:
+            # Claim the unit: only one of concurrent sells changes delflg from 0 to 1
+            if cursor.execute(self.unit_claim_sql,
+                              [subject_id]).rowcount == 0:
                 print('There are no goods at the warehouse')
             else:
+                self.add_log(operation='update',
+                             subject='Goods',
+                             data=subject_id)
 
-                try:  # Getting personal customers discount
-                    sql = '''select Customers_sales.discount from customers left join Customers_sales 
-                            on customers.id = Customers_sales.customer_id where customers.id = ?'''
-                    discount = cursor.execute(
-                        sql, [customer_id]).fetchone()[0] / 100
-                except:
-                    discount = 0
-
-                if discount == 0:
-                    try:  # Getting category discount
-                        sql = '''select * from Goods 
-                                    left join Categories_sales on
-                                    Categories_sales.category_id = Goods.categoryId where Goods.id = ?'''
-                        if cursor.execute(sql,
-                                          [subject_id]).fetchone()[8] is None:
-                            discount = 0
-                        else:
-                            discount = cursor.execute(
-                                sql, [subject_id]).fetchone()[8] / 100
-                    except Exception as e:
-                        print('Error: ', e)
-                        discount = 0
-
-                sql = '''select price from Goods where id = ?'''
-                price = cursor.execute(sql, [subject_id]).fetchone()[0]
-                sql = '''insert into Transactions(type, total, subject_id, quantity, customer_id, discount, 
-                                                    additionalInfo, date) 
-                        values(?,?,?,?,?,?,?,?)'''
+                _, price, discount, _ = self.sell_prices(cursor, [subject_id],
+                                                         customer_id,
+                                                         delflg=1)[0]
                 data = (type, round(price * (1 - discount), 2), subject_id,
                         quantity, customer_id, discount, additionalInfo, date)
-                cursor.execute(sql, data)
+                cursor.execute(self.sell_insert_sql, data)
+                self.rollups_add(cursor, [(type, data[1], customer_id, date)])
                 self.add_log(operation='insert',
                              subject='Transactions',
                              data=str(data))
 
-                sql = '''update Goods set delflg = 1 where id = ?'''
+        elif type == 'return' and self.inventory == 'ledger':
+            self.quantity_check(quantity)
+            cursor = self.con.cursor()
 
-                cursor.execute(sql, [subject_id])
+            # Only sold and not yet returned quantity can be returned
+            sold = cursor.execute(self.stock_returnable_sql,
+                                  [subject_id]).fetchone()[0]
+            if not sold or sold < quantity:
+                print('There wasn\'t sold such goods')
+            else:
+                cursor.execute(self.stock_return_sql, [quantity, subject_id])
                 self.add_log(operation='update',
-                             subject='Goods',
-                             data=subject_id)
-                con.commit()
+                             subject='Stock',
+                             data=str((subject_id, quantity)))
+
+                total = round(
+                    cursor.execute(self.stock_refund_sql,
+                                   [subject_id, subject_id]).fetchone()[0] *
+                    quantity, 2)
+
+                sql = '''insert into Transactions(type, total, subject_id, quantity, date) values(?,?,?,?,?)'''
+                cursor.execute(sql, [type, total, subject_id, quantity, date])
+                cursor.execute(self.movement_insert_sql,
+                               [subject_id, type, quantity,
+                                cursor.lastrowid, date])
+                self.rollups_add(cursor, [(type, total, None, date)])
+                self.add_log(operation='insert',
+                             subject='Transactions',
+                             data=str((type, total, subject_id, quantity,
+                                       date)))
 
         elif type == 'return':
             quantity = 1
-            con = sqlite3.connect(self.database)
+            con = self.con
             cursor = con.cursor()
 
-            if (cursor.execute(
-                    '''select count(*)
-                                    from Goods
-                                    where Goods.id = ? and Goods.delflg = 1''',
-                [subject_id]).fetchone()[0]) == 0:
+            # Claim the sold unit back, so it can't be returned twice
+            if cursor.execute(self.unit_return_sql,
+                              [subject_id]).rowcount == 0:
                 print('There wasn\'t sold such goods')
             else:
-                try:
-                    sql = '''select total from Transactions where Transactions.subject_id = ? 
-                    and Transactions.type = \'sell\''''
-                    total = cursor.execute(sql, [subject_id]).fetchone()[0]
-
-                    sql = '''insert into Transactions(type, total, subject_id, quantity, date) values(?,?,?,?,?)'''
-                    cursor.execute(sql,
-                                   [type, total, subject_id, quantity, date])
-                    self.add_log(operation='insert',
-                                 subject='Transactions',
-                                 data=str(type, total, subject_id, quantity,
-                                          date))
-
-                    sql = '''update Goods set delflg = 0 where id = ?'''
-                    cursor.execute(sql, [subject_id])
-                    self.add_log(operation='update',
-                                 subject='Goods',
-                                 data=str(subject_id))
+                self.add_log(operation='update',
+                             subject='Goods',
+                             data=str(subject_id))
 
-                    con.commit()
+                total = cursor.execute(self.unit_refund_sql,
+                                       [subject_id]).fetchone()[0]
 
-                except Exception as e:
-                    print('Error:', e)
+                sql = '''insert into Transactions(type, total, subject_id, quantity, date) values(?,?,?,?,?)'''
+                cursor.execute(sql, [type, total, subject_id, quantity, date])
+                self.rollups_add(cursor, [(type, total, None, date)])
+                self.add_log(operation='insert',
+                             subject='Transactions',
+                             data=str((type, total, subject_id, quantity,
+                                       date)))
 
         elif type == 'delivery':
-            con = sqlite3.connect(self.database)
+            con = self.con
             cursor = con.cursor()
             sql = '''insert into Transactions(type, total, subject_id, quantity, customer_id, discount, additionalInfo, date) 
                     values(?,?,?,?,?,?,?,?)'''
             data = (type, total, subject_id, quantity, customer_id, discount,
                     additionalInfo, date)
             cursor.execute(sql, data)
+            self.rollups_add(cursor, [(type, total, customer_id, date)])
             self.add_log(operation='insert',
                          subject='Transactions',
                          data=str(data))
-            con.commit()
 
+    @write_operation
+    def sell_many(self, basket, customer_id=None, additionalInfo=None,
+                  date=None):
+        """
+        Sell basket of goods in one transaction.
+        Prices and discounts of all goods are taken by one query, units are claimed and
+        transactions are inserted by executemany.
+
+        Parameters
+        ----------
+            basket : List of goods' ids
+
+            customer_id : Buyer, his personal discount has priority over category discounts
+
+            date : Date of transactions. Today as default.
+
+        Returns
+        -------
+            Dict with 'sold' - list of (good_id, total, discount), 'missing' - ids of goods,
+            that aren't at the warehouse (or are repeated in the basket more times, than
+            there are units), and 'total'. In 'ledger' inventory ids are ids of Stock.
+
+        """
+
+        if date is None:
+            date = datetime.date.today()
+        cursor = self.con.cursor()
+
+        prices = {
+            row[0]: row
+            for row in self.sell_prices(cursor, basket, customer_id)
+        }
+        available = {good_id: row[3] for good_id, row in prices.items()}
+        sold, missing = [], []
+        for good_id in basket:
+            if not available.get(good_id):
+                missing.append(good_id)
+                continue
+            available[good_id] -= 1
+            _, price, discount, _ = prices[good_id]
+            sold.append((good_id, round(price * (1 - discount), 2), discount))
+
+        if self.inventory == 'ledger':
+            claimed = [(prices[good_id][3] - left, good_id,
+                        prices[good_id][3] - left)
+                       for good_id, left in available.items()
+                       if left < prices[good_id][3]]
+            sql = self.stock_claim_sql
+            subject = 'Stock'
+        else:
+            claimed = [(item[0], ) for item in sold]
+            sql = self.unit_claim_sql
+            subject = 'Goods'
+        if cursor.executemany(sql, claimed).rowcount != len(claimed):
+            raise sqlite3.IntegrityError('Goods were sold by another checkout')
+        data = [('sell', total, good_id, 1, customer_id, discount,
+                 additionalInfo, date) for good_id, total, discount in sold]
+        cursor.executemany(self.sell_insert_sql, data)
+        self.rollups_add(cursor, [('sell', total, customer_id, date)
+                                  for _, total, _ in sold])
+
+        if self.inventory == 'ledger' and sold:
+            # Ids of transactions, inserted by this writer in one transaction, are consecutive
+            last_id = cursor.execute(
+                '''select max(id) from Transactions''').fetchone()[0]
+            cursor.executemany(
+                self.movement_insert_sql,
+                [(good_id, 'sell', -1, last_id - len(sold) + 1 + i, date)
+                 for i, (good_id, _, _) in enumerate(sold)])
+
+        self.add_logs([('update', subject, str(item)) for item in claimed] +
+                      [('insert', 'Transactions', str(item))
+                       for item in data])
+        if missing:
+            print('There are no goods at the warehouse:', missing)
+        return {
+            'sold': sold,
+            'missing': missing,
+            'total': sum(item[1] for item in sold)
+        }
+
+    def sell_prices(self, cursor, goods_ids, customer_id=None, delflg=0):
+        """
+        Return list of (id, price, discount, available) of goods with given delflg.
+        Prices are taken by one query (per 500 goods), discounts - from discount_cache.
+        Available is 1 for unit of Goods and quantity of article in 'ledger' inventory,
+        where goods_ids are ids of Stock and delflg isn't used.
+
+        """
+
+        if len(goods_ids) > 500:
+            rows = []
+            for start in range(0, len(goods_ids), 500):
+                rows += self.sell_prices(cursor, goods_ids[start:start + 500],
+                                         customer_id, delflg)
+            return rows
+
+        customers_discounts, categories_discounts = self.discount_cache()
+        customer_discount = customers_discounts.get(customer_id)
+
+        sql = self.sell_prices_sql[self.inventory] % ','.join(
+            '?' * len(goods_ids))
+        params = goods_ids if self.inventory == 'ledger' else [
+            *goods_ids, delflg
+        ]
+        return [(good_id, price,
+                 self.sell_discount(customer_discount,
+                                    categories_discounts.get(category_id)),
+                 available)
+                for good_id, price, category_id, available in cursor.execute(
+                    sql, params)]
+
+    def rollups_add(self, cursor, transactions):
+        """
+        Add transactions, inserted by cursor, to Revenue_daily and Customers_daily.
+        Must be called in the same database transaction, as the insert of transactions.
+
+        Parameters
+        ----------
+            transactions : List of (type, total, customer_id, date)
+
+        """
+
+        revenue, orders = {}, {}
+        for type, total, customer_id, date in transactions:
+            day_total, count = revenue.get((date, type), (0, 0))
+            revenue[(date, type)] = (day_total + (total or 0), count + 1)
+            if type == 'sell' and customer_id is not None:
+                orders[(date, customer_id)] = orders.get(
+                    (date, customer_id), 0) + 1
+
+        cursor.executemany(
+            '''insert into Revenue_daily(date, type, total, transactions) values(?,?,?,?)
+               on conflict(date, type) do update set
+               total = round(total + excluded.total, 2),
+               transactions = transactions + excluded.transactions''',
+            [(*key, *value) for key, value in revenue.items()])
+        cursor.executemany(
+            '''insert into Customers_daily(date, customer_id, orders) values(?,?,?)
+               on conflict(date, customer_id) do update set
+               orders = orders + excluded.orders''',
+            [(*key, value) for key, value in orders.items()])
+
+    @write_operation
+    def rollups_rebuild(self):
+        """
+        Fill Revenue_daily and Customers_daily again from all Transactions, e.g. after
+        transactions were changed by sql_execution.
+
+        """
+
+        cursor = self.con.cursor()
+        cursor.execute('''delete from Revenue_daily''')
+        cursor.execute('''delete from Customers_daily''')
+        for sql in self.rollups_sql:
+            cursor.execute(sql)
+        self.add_log(operation='rebuild',
+                     subject='Revenue_daily, Customers_daily')
+
+    @write_operation
+    def inventory_migrate(self):
+        """
+        Migrate 'units' inventory to 'ledger' one. Units of Goods are grouped into
+        articles of Stock by title, price and category: quantity of article is the number
+        of units in stock. Opening balance and units, sold before migration, are recorded
+        in Stock_movements, so they can be returned. Goods table is kept as is.
+
+        """
+
+        cursor = self.con.cursor()
+        cursor.execute('''insert into Stock(title, price, categoryId, quantity)
+                          select title, price, categoryId, sum(delflg = 0) from Goods
+                          group by title, price, categoryId
+                          on conflict(title, price, categoryId)
+                          do update set quantity = quantity + excluded.quantity''')
+        cursor.execute('''insert into Stock_movements(stock_id, type, quantity)
+                          select Stock.id, Movements.type, sum(Movements.quantity)
+                          from (select title, price, categoryId, \'migration\' as type,
+                                       delflg = 0 as quantity from Goods
+                                union all
+                                select title, price, categoryId, \'sell\', -(delflg = 1)
+                                from Goods) as Movements
+                          join Stock on Stock.title is Movements.title
+                                    and Stock.price is Movements.price
+                                    and Stock.categoryId is Movements.categoryId
+                          group by Stock.id, Movements.type
+                          having sum(Movements.quantity) != 0''')
+        cursor.execute(
+            '''update Settings set value = \'ledger\' where name = \'inventory\'''')
+        self.inventory = 'ledger'
+        self.add_log(operation='migrate', subject='Stock', data='ledger')
+
+    def stock_level(self, id):
+        """
+        Return number of units of the article in stock. In 'ledger' inventory id is id of
+        Stock and its quantity is read, otherwise units of Goods with the same title,
+        price and category as the good are counted, as articles of Stock are grouped.
+
+        """
+
+        row = self.reader().execute(self.stock_level_sql[self.inventory],
+                                    [id]).fetchone()
+        return row[0] if row else 0
+
+    def discount_cache(self):
+        """
+        Return dicts of active personal discounts by customer_id and category discounts
+        by category_id. They are loaded from Customers_sales and Categories_sales once
+        and reloaded, when discounts_version in Settings is changed. It's increased by
+        triggers on any change of these tables, by Market or by other connections.
+        If there are several active discounts, the first added is used.
+
+        """
+
+        cursor = self.con.cursor()
+        version = cursor.execute(self.discounts_version_sql).fetchone()[0]
+        if self.discounts is None or version != self.discounts_version:
+            self.discount_misses += 1
+            customers_discounts = dict(
+                cursor.execute('''select customer_id, discount from Customers_sales
+                                  where active = '1' order by id desc'''))
+            categories_discounts = dict(
+                cursor.execute('''select category_id, discount from Categories_sales
+                                  where active = '1' order by id desc'''))
+            self.discounts = (customers_discounts, categories_discounts)
+            self.discounts_version = version
+        else:
+            self.discount_hits += 1
+        return self.discounts
+
+    def discount_stats(self):
+        """Return hits and misses (loads from database) of discount_cache."""
+
+        return {
+            'hits': self.discount_hits,
+            'misses': self.discount_misses,
+            'customers': len(self.discounts[0]) if self.discounts else 0,
+            'categories': len(self.discounts[1]) if self.discounts else 0,
+        }
+
+    @staticmethod
+    def quantity_check(quantity):
+        """Return quantity of units, if it's a positive integer. Raise ValueError otherwise."""
+
+        if isinstance(quantity, bool) or not isinstance(
+                quantity, numbers.Integral) or quantity <= 0:
+            raise ValueError('Quantity must be a positive integer, not %r' %
+                             (quantity, ))
+        return quantity
+
+    @staticmethod
+    def sell_discount(customer_discount, category_discount):
+        """Personal discount has priority over category discount. Return share of price."""
+
+        if customer_discount:
+            return customer_discount / 100
+        if category_discount:
+            return category_discount / 100
+        return 0
+
+    @write_operation
     def category_sale_add(self,
                           title=None,
                           category_id=0,
                           discount=0,
                           active=0):
         """Adds discount at one of the categories."""
-        con = sqlite3.connect(self.database)
+        con = self.con
         cursor = con.cursor()
         sql = '''insert into Categories_sales(title,category_id,discount,active) values(?,?,?,?)'''
         data = (title, category_id, discount, active)
@@ -550,15 +2576,15 @@ class Market:
         self.add_log(operation='insert',
                      subject='Categories_sales',
                      data=str(data))
-        con.commit()
 
+    @write_operation
     def customer_sale_add(self,
                           customer_id=0,
                           title=None,
                           discount=0,
                           active=0):
         """Adds personal discount to the customer."""
-        con = sqlite3.connect(self.database)
+        con = self.con
         cursor = con.cursor()
         sql = '''insert into Customers_sales(customer_id, title, discount, active) values(?,?,?,?)'''
         data = (customer_id, title, discount, active)
@@ -566,124 +2592,166 @@ class Market:
         self.add_log(operation='insert',
                      subject='Customers_sales',
                      data=str(data))
-        con.commit()
 
     def goods_sell(self, id):
         """Takes good's id, marks it as sold and add a transaction."""
 
-        try:
-            con = sqlite3.connect(self.database)
-            cursor = con.cursor()
-            sql = '''update Goods set delflg = 1 WHERE id = ?'''
-            cursor.execute(sql, [id])
-            self.add_log(operation='update', subject='Goods', data=str(id))
-
-            # get information about good
-            sql = '''select * from Goods where id = ?'''
-            result = cursor.execute(sql, [id]).fetchone()
-            con.commit()
-            self.transactions_add(type='sell', total=result[2], subject_id=id)
-        except Exception as e:
-            print('An error occurred. Database wasn\'t updated.')
-            print('Error:', e)
+        self.transactions_add(type='sell', subject_id=id)
 
     def revenue_stat(self,
-                     start_date=pd.datetime.now().date() -
-                     pd.Timedelta('30 days'),
-                     end_date=pd.datetime.now().date()):
+                     start_date=None,
+                     end_date=None,
+                     verbose=True):
         """
-        Print statistics between two dates by days.
+        Return statistics between two dates by days.
+        Totals are read from Revenue_daily rollup, signed and summed by days in SQL:
+        sells are income, deliveries and returns are outcome. Days with positive
+        total are summed into income, with negative one - into outcome.
+        Results are cached, see cached.
 
         Parameters:
         -----------
             start_date: First day of period. As default value set today - 30 days
             end_date: Last day of periods. Today as default.
+            verbose : If True, statistics are printed.
+
+        Returns
+        -------
+            Dict with 'by_date' - dataframe of totals indexed by date, 'income', 'outcome'
+            and 'balance'.
 
         """
-        income = 0
-        outcome = 0
-        con = sqlite3.connect(self.database)
-        cursor = con.cursor()
-        result = cursor.execute(
-            '''select id,type,total,date from transactions where date between ? and ?''',
-            [start_date, end_date]).fetchall()
-        con.commit()
 
-        # Convert to dataframe
-        df = pd.DataFrame(result, columns=['id', 'type', 'total', 'date'])
+        start_date, end_date = self.stat_period(start_date, end_date)
 
-        # Set sign, depends of operations type
-        counter = 0
-        for elem in df['type']:
-            if (elem == 'delivery') or (elem == 'return'):
-                df.iloc[counter, 2] *= -1
-            counter += 1
+        stats = self.revenue_report(start_date, end_date)
+        stats = dict(stats, by_date=stats['by_date'].copy())
 
-        # Print statistics by date
-        print(df[['date', 'total']].groupby(by='date').sum())
+        if verbose:
+            print(stats['by_date'])
+            print('Income:', stats['income'], 'Outcome:', stats['outcome'],
+                  'Balance:', stats['balance'])
+        return stats
 
-        # Calculate in- and outcome
-        for elem in df.groupby(by='date').sum()['total']:
-            if elem >= 0:
-                income += elem
-            else:
-                outcome += elem
+    @staticmethod
+    def stat_period(start_date=None, end_date=None):
+        """Return period of statistics: today - 30 days and today as default."""
 
-        print('Income:', income, 'Outcome:', outcome, 'Balance:',
-              income - abs(outcome))
+        if end_date is None:
+            end_date = datetime.date.today()
+        if start_date is None:
+            start_date = datetime.date.today() - datetime.timedelta(days=30)
+        return start_date, end_date
+
+    @cached_report
+    def revenue_report(self, start_date, end_date):
+        """Return statistics of revenue_stat between two dates."""
+
+        con = self.reader()
+        cursor = con.cursor()
+        result = cursor.execute(self.revenue_sql,
+                                [start_date, end_date]).fetchall()
+        con.commit()
+
+        df = pd.DataFrame(result, columns=['date', 'total']).set_index('date')
+        income = df.total[df.total >= 0].sum()
+        outcome = df.total[df.total < 0].sum()
+        return {
+            'by_date': df,
+            'income': income,
+            'outcome': outcome,
+            'balance': income - abs(outcome)
+        }
 
     def user_stat(self,
-                  start_date=pd.datetime.now().date() -
-                  pd.Timedelta('30 days'),
-                  end_date=pd.datetime.now().date(),
-                  level=0.2):
+                  start_date=None,
+                  end_date=None,
+                  level=0.2,
+                  verbose=True):
         """
-        Print size of an average transaction between two dates by customer.
+        Return size of an average transaction between two dates by customer and
+        customers with low activity. Orders are counted by one query over
+        Customers_daily and Revenue_daily rollups, several levels reuse its result.
+        Results of the query are cached, see cached.
 
         Parameters:
         -----------
             start_date: First day of period. As default value set today - 30 days
             end_date: Last day of periods. Today as default.
-            level : threshold of customers with low activity.
+            level : threshold of customers with low activity, share of the average.
+                    Can be a list of thresholds.
+            verbose : If True, statistics are printed.
+
+        Returns
+        -------
+            Dict with 'average' - average number of orders by day, 'level', 'threshold' -
+            number of orders, that is level of average, and 'low_activity' - dataframe
+            of customers with less orders, than threshold.
+            List of such dicts, if level is a list.
 
         """
 
-        con = sqlite3.connect(self.database)
-        cursor = con.cursor()
-        result = cursor.execute(
-            '''select customer_id, date from transactions 
-                                    where date between ? and ? and type = 'sell\' order by date''',
-            [start_date, end_date]).fetchall()
+        start_date, end_date = self.stat_period(start_date, end_date)
+
+        avg_transactions, data = self.user_report(start_date, end_date)
+        if verbose:
+            print('Avg transactions pro customer: ', avg_transactions)
+
+        stats = []
+        for share in (level if isinstance(level, (list, tuple)) else [level]):
+            threshold = avg_transactions * share
+            low_activity = data[data.orders < threshold].reset_index(drop=True)
+            stats.append({
+                'average': avg_transactions,
+                'level': share,
+                'threshold': threshold,
+                'low_activity': low_activity
+            })
+            if verbose:
+                print('Customers with %.0f%% of average transactions:' %
+                      (share * 100))
+                if len(low_activity) > 0:
+                    print(low_activity)
+                else:
+                    print('No such users or enough data')
 
-        con.commit()
+        return stats if isinstance(level, (list, tuple)) else stats[0]
 
-        df = pd.DataFrame(result, columns=['customer_id', 'date'])
-        df.index = range(len(df.index))
+    @cached_report
+    def user_report(self, start_date, end_date):
+        """Return average number of orders by day and dataframe of orders by customer between two dates."""
 
-        avg_transactions = df['customer_id'].groupby(by=df.date).count().mean()
-        print('Avg transactions pro customer: ', avg_transactions)
+        con = self.reader()
+        cursor = con.cursor()
+        result = cursor.execute(self.user_stat_sql, {
+            'start_date': start_date,
+            'end_date': end_date
+        }).fetchall()
+        con.commit()
 
-        data = df.groupby(by=['customer_id']).count()
-        data.reset_index(inplace=True)
+        days, total = result[0][0], result[0][3] or 0
+        data = pd.DataFrame([row[1:3] for row in result if row[1] is not None],
+                            columns=['customer_id', 'orders'])
+        return (total / days if days else float('nan')), data
 
-        print('Customers with 20% of average transactions:')
-        data = data.rename(columns={"date": "orders"})
+    def add_log(self,
+                operation='Unknown',
+                subject='Unknown',
+                data='Unknown',
+                durable=None):
+        """
+        Add all type, table and query of executed operations in logging database.
+        Entry is buffered, if durable is True (or Market is created with durable_log)
+        it is committed before return.
 
-        if len(data[data.orders < avg_transactions * level]) > 0:
-            print(data[data.orders < avg_transactions * level])
-        else:
-            print('No such users or enough data')
+        """
 
-    def add_log(self, operation='Unknown', subject='Unknown', data='Unknown'):
-        """Add all type, table and query of executed operations in logging database."""
+        self.log.add(operation, subject, data, durable)
 
-        con = sqlite3.connect(self.log_db)
-        cursor = con.cursor()
+    def add_logs(self, entries, durable=None):
+        """Add list of (operation, subject, data) into logging database by one batch."""
 
-        sql = '''insert into log_table(operation,subject,data) values(?,?,?)'''
-        data = (operation, subject, data)
-        cursor.execute(sql, data)
-        con.commit()
+        self.log.add_many(entries, durable)
 
     @staticmethod
     def dbname_check(name):
@@ -701,196 +2769,336 @@ class Market:
             )
         return db_name
 
+    @staticmethod
+    def csv_read(file, chunksize=None):
+        """
+        Read csv file (path or text file-like object) line by line into dataframes with
+        one column 'chunk'. Empty lines are skipped, index is the number of the line in the file.
+        Generator yields dataframes with at most chunksize rows (whole file if chunksize is not set).
+
+        """
+
+        with (contextlib.nullcontext(file) if hasattr(file, 'read') else open(
+                file, encoding='utf-8')) as f:
+            start = 0
+            while True:
+                lines = list(itertools.islice(f, chunksize))
+                if not lines and start > 0:
+                    break
+                chunk = pd.DataFrame(
+                    {'chunk': [line.rstrip('\r\n') for line in lines]},
+                    index=range(start, start + len(lines)))
+                start += len(lines)
+                yield chunk[chunk['chunk'] != '']
+                if not chunksize or not lines:
+                    break
+
+    @staticmethod
+    def validation(table):
+        """Return validation method of source table (categories, goods or customers)."""
+
+        return {
+            'categories': Market.category_validation,
+            'goods': Market.goods_validation,
+            'customers': Market.customers_validation,
+        }[table]
+
+    @staticmethod
+    def prepare_chunk(table, raw_df):
+        """
+        Convert and validate raw lines of source table. Used by worker processes of parallel_import.
+        Return validated, rejected and malformed dataframes.
+
+        """
+
+        columns_list = Market.import_layouts[table]
+        converted_df, malformed_df = Market.import_converting(
+            raw_df, len(columns_list), columns_list)
+        accepted_df, rejected_df = Market.validation(table)(converted_df)
+        return accepted_df, rejected_df, malformed_df
+
+    @staticmethod
+    def locators_prepare(df):
+        """Take validated customers dataframe and return columns for Locators table."""
+
+        return df[['first_name', 'last_name', 'email', 'additionalInfo']][:]
+
     @staticmethod
     def import_converting(df, columns_number, columns_list, sep=','):
         """
         In depends on the number of columns split string into required fields.
-        This is necessary in order to avoid the error caused by the separator in the name of the product or category.
-
-        """
-
-        converted_df = pd.DataFrame(columns=columns_list)
-        i = 0
-        while i < df.count()[0]:
-            if df.iloc[i, 0].count(sep) < columns_number - 1:
-                print('Error:', df.iloc[i, 0])
-            if df.iloc[i, 0].count(sep) >= columns_number - 1:
-
-                # Search all substrings(sep) in strings(rows):
-                sep_position = [
-                    pos for pos in range(len(df.iloc[i, 0]))
-                    if df.iloc[i, 0].startswith(sep, pos)
-                ]
-
-                if columns_number == 3:
-                    # Split data(chars) to columns :
-                    #   id:             to 1. separator
-                    #   title:          between 1. and 2. sep-s
-                    #   description:    from 2. to end
-                    converted_df = converted_df.append(
-                        {
-                            'id':
-                            df.iloc[i, 0][0:sep_position[0]],
-                            'title':
-                            df.iloc[i, 0][sep_position[0] + 1:sep_position[1]],
-                            'description':
-                            df.iloc[i, 0][sep_position[1] + 1:]
-                        },
-                        ignore_index=True)
-                if columns_number == 4:
-                    # Split data(chars) to columns :
-                    #   id:             to 1. separator
-                    #   title:          between 1. and 2. sep-s
-                    #   price:          between 2. and 3. sep-s
-                    #   categoryId:          from 2. to end
-                    converted_df = converted_df.append(
-                        {
-                            'id':
-                            df.iloc[i, 0][0:sep_position[0]],
-                            'title':
-                            df.iloc[i, 0][sep_position[0] + 1:sep_position[1]],
-                            'price':
-                            df.iloc[i, 0][sep_position[1] + 1:sep_position[2]],
-                            'categoryId':
-                            df.iloc[i, 0][sep_position[2] + 1:]
-                        },
-                        ignore_index=True)
-                if columns_number == 5:
-                    # Split data(chars) to columns :
-                    #   id:             to 1. separator
-                    #   first_name:     between 1. and 2. sep-s
-                    #   last_name:      between 2. and 3. sep-s
-                    #   email:          between 2. and 3. sep-s
-                    #   email:          between 3. to end
-                    converted_df = converted_df.append(
-                        {
-                            'id':
-                            df.iloc[i, 0][0:sep_position[0]],
-                            'first_name':
-                            df.iloc[i, 0][sep_position[0] + 1:sep_position[1]],
-                            'last_name':
-                            df.iloc[i, 0][sep_position[1] + 1:sep_position[2]],
-                            'email':
-                            df.iloc[i, 0][sep_position[2] + 1:sep_position[3]],
-                            'gender':
-                            df.iloc[i, 0][sep_position[3] + 1:]
-                        },
-                        ignore_index=True)
-                i += 1
-        return converted_df
+        First (columns_number - 1) separators split the fields, the remainder of the string
+        goes to the last field. This is necessary in order to avoid the error caused by the
+        separator in the name of the product or category.
+
+        Whole column is split in one pass, rows with less than (columns_number - 1)
+        separators are not converted. Index of original dataframe is kept.
+
+        Returns
+        -------
+            converted_df : Dataframe with columns from columns_list
+
+            malformed_df : Rows of original dataframe, that couldn't be converted
+
+        """
+
+        lines = df.iloc[:, 0].astype(str)
+        malformed = lines.str.count(re.escape(sep)) < columns_number - 1
+        malformed_df = df[malformed]
+
+        if malformed.all():
+            return pd.DataFrame(columns=columns_list), malformed_df
+
+        # Split data(chars) to columns, e.g. for categories:
+        #   id:             to 1. separator
+        #   title:          between 1. and 2. sep-s
+        #   description:    from 2. to end
+        converted_df = lines[~malformed].str.split(sep,
+                                                   n=columns_number - 1,
+                                                   expand=True)
+        converted_df.columns = columns_list
+        return converted_df, malformed_df
+
+    @staticmethod
+    def column_check(column, check):
+        """
+        Return boolean mask of valid values of the column.
+
+        Checks:
+        -------
+            numeric : Only digits
+
+            number : Non-negative number, e.g. 9.99
+
+            integer : Non-negative number without fraction, e.g. 2 or 2.0
+
+            positive_integer : Number without fraction greater than 0
+
+            not_empty : Not empty string
+
+            alpha_words : Words separated by single spaces, each word consists of letters
+
+            alnum_words : Words separated by single spaces, each word consists of letters and digits
+
+            gender : male or female in any case
+
+            email : Has '@' after the first char, '.' after the third char and ends with a letter
+
+        """
+
+        # Missing values (None, NaN) are empty strings, they don't pass any check
+        column = column.where(column.notna(), '').astype(str)
+        if check == 'numeric':
+            return column.str.isnumeric()
+        if check in ('number', 'integer', 'positive_integer'):
+            values = pd.to_numeric(column, errors='coerce')
+            valid = (values >= 0) & (values < float('inf'))
+            if check != 'number':
+                valid &= values % 1 == 0
+            if check == 'positive_integer':
+                valid &= values > 0
+            return valid
+        if check == 'not_empty':
+            return column != ''
+        if check in ('alpha_words', 'alnum_words'):
+            chars = column.str.replace(' ', '', regex=False)
+            chars_valid = chars.str.isalpha() if check == 'alpha_words' \
+                else chars.str.isalnum()
+            return (chars_valid
+                    & ~column.str.contains('  ', regex=False)
+                    & ~column.str.startswith(' ')
+                    & ~column.str.endswith(' '))
+        if check == 'gender':
+            return column.str.lower().isin(['male', 'female'])
+        if check == 'email':
+            return ((column.str.find('@') >= 1)
+                    & (column.str.find('.') >= 3)
+                    & column.str[-1:].str.isalpha())
+        raise ValueError('Unknown check: %s' % check)
+
+    @staticmethod
+    def rules_validation(df, rules):
+        """
+        Check all rules over whole columns of dataframe.
+
+        Parameters
+        ----------
+            df : Dataframe to validate
+
+            rules : List of (reason code, column, check), see column_check
+
+        Returns
+        -------
+            accepted_df : Rows, that passed all rules
+
+            rejected_df : Rows, that failed at least one rule. Column 'reason' contains
+                          reason codes separated by commas.
+
+        """
+
+        reason = pd.Series('', index=df.index)
+        for code, column, check in rules:
+            failed = ~Market.column_check(df[column], check)
+            reason = reason + failed.map({True: code + ',', False: ''})
+        rejected = reason != ''
+
+        rejected_df = df[rejected].copy()
+        rejected_df['reason'] = reason[rejected].str[:-1]
+        return df[~rejected].copy(), rejected_df
 
     @staticmethod
     def customers_validation(df):
-        """Validate dataframe according to types of Goods table in database.  Return checked validated dataframe."""
+        """
+        Validate dataframe according to types of Customers table in database.
+        Incorrect emails are moved to additional info.
+        Return validated dataframe and dataframe with rejected rows.
 
-        df['additionalInfo'] = ''
-        i = 0
-        exception_counter = 0
-        while i < df.count()[0]:
-            try:
-                if not df.iloc[i, 0].isnumeric():
-                    print('Table: Customers. Error with id in row:', i,
-                          'It will be deleted.')
-                    df = df.drop(i + exception_counter, axis=0)
-                    exception_counter += 1
-
-                for word in df.iloc[i, 1].split(sep=' '):
-                    if not word.isalpha():
-                        print(
-                            'Table: Customers. Error with first name in row:',
-                            i, 'It will be deleted.')
-                        df = df.drop(i + exception_counter, axis=0)
-                        exception_counter += 1
-
-                for word in df.iloc[i, 2].split(sep=' '):
-                    if not word.isalpha():
-                        print('Table: Customers. Error with last name in row:',
-                              i, 'It will be deleted.')
-                        df = df.drop(i + exception_counter, axis=0)
-                        exception_counter += 1
-
-                if (df.iloc[i, 3].find('@')
-                        < 1) or (df.iloc[i, 3].find('.')
-                                 < 3) or not (df.iloc[i, 3][-1].isalpha()):
-                    print('Table: Customers. Incorrect email in row:', i,
-                          'was moved to additional info.')
-                    df.additionalInfo[i + exception_counter] = df.email[
-                        i + exception_counter]
-                    df.email[i + exception_counter] = ''
-
-                if not (df.iloc[i, 4].lower() == 'male'
-                        or df.iloc[i, 4].lower() == 'female'):
-                    print('Table: Persons. Error with gender in row:', i,
-                          'It will be deleted.')
-                    df = df.drop(i + exception_counter, axis=0)
-                    exception_counter += 1
-
-                i += 1
-            except Exception:
-                i += 1
-        print(exception_counter, 'rows were deleted')
-        return df
+        """
+
+        accepted_df, rejected_df = Market.rules_validation(
+            df, [('id', 'id', 'numeric'),
+                 ('first_name', 'first_name', 'alpha_words'),
+                 ('last_name', 'last_name', 'alpha_words'),
+                 ('gender', 'gender', 'gender')])
+
+        accepted_df['additionalInfo'] = ''
+        wrong_email = ~Market.column_check(accepted_df['email'], 'email')
+        if wrong_email.any():
+            print('Table: Customers.', wrong_email.sum(),
+                  'incorrect emails were moved to additional info.')
+            accepted_df.loc[wrong_email,
+                            'additionalInfo'] = accepted_df.loc[wrong_email,
+                                                                'email']
+            accepted_df.loc[wrong_email, 'email'] = ''
+
+        print('Table: Customers.', len(rejected_df), 'rows were deleted')
+        return accepted_df, rejected_df
 
     @staticmethod
     def goods_validation(df):
-        """Validate dataframe according to types of Goods table in database.  Return checked validated dataframe."""
-        i = 0
-        exception_counter = 0
-        while i < df.count()[0]:
-            try:
-                if not df.iloc[i, 0].isnumeric():
-                    print('Table: Goods. Error with id in row:', i,
-                          'It will be deleted.')
-                    df = df.drop(i + exception_counter, axis=0)
-                    exception_counter += 1
-                if df.iloc[i, 1] == '':
-                    print('Table: Goods. Error with title in row:', i,
-                          'It will be deleted.')
-                    df = df.drop(i + exception_counter, axis=0)
-                    exception_counter += 1
-                if not df.iloc[i, 2].isnumeric():
-                    print('Table: Goods. Error with price in row:', i,
-                          'It will be deleted.')
-                    df = df.drop(i + exception_counter, axis=0)
-                    exception_counter += 1
-                if not df.iloc[i, 3].isnumeric():
-                    print('Table: Goods. Error with category_id in row:', i,
-                          'It will be deleted.')
-                    df = df.drop(i + exception_counter, axis=0)
-                    exception_counter += 1
-                i += 1
-            except:
-                pass
-        print(exception_counter, 'rows were deleted')
-        return df
+        """Validate dataframe according to types of Goods table in database.
+        Return validated dataframe and dataframe with rejected rows."""
+
+        accepted_df, rejected_df = Market.rules_validation(
+            df, [('id', 'id', 'numeric'), ('title', 'title', 'not_empty'),
+                 ('price', 'price', 'numeric'),
+                 ('category_id', 'categoryId', 'numeric')])
+
+        print('Table: Goods.', len(rejected_df), 'rows were deleted')
+        return accepted_df, rejected_df
 
     @staticmethod
     def category_validation(df):
-        """ Validate counts and types of rows to insert into Category table"""
+        """Validate counts and types of rows to insert into Category table.
+        Return validated dataframe and dataframe with rejected rows."""
+
+        accepted_df, rejected_df = Market.rules_validation(
+            df, [('id', 'id', 'numeric'), ('title', 'title', 'alnum_words'),
+                 ('description', 'description', 'alnum_words')])
+
+        print('Table: Categories.', len(rejected_df), 'rows were deleted')
+        return accepted_df, rejected_df
+
+
+class AsyncMarket:
+    """
+    Asyncio facade of Market in concurrent mode.
+
+    Writes are put directly into the queue of the market's writer thread and awaited
+    without occupying a thread, reports run on a thread pool with read-only connections.
+    Number of calls in flight is limited by max_in_flight: further calls wait until
+    one of them is finished (backpressure), so the event loop is never blocked.
+
+    Parameters
+    ----------
+        market : Market(concurrent=True). It isn't closed by AsyncMarket.
+
+        max_in_flight : Max number of calls, executed or queued at the same time
+
+        workers : Number of threads for reports
+
+    """
 
-        i = 0
-        exception_counter = 0
-        while i < df.count()[0]:
+    def __init__(self, market, max_in_flight=256, workers=4):
+        if market.writer is None:
+            raise ValueError('AsyncMarket requires Market(concurrent=True)')
+        self.market = market
+        self.max_in_flight = max_in_flight
+        self.semaphore = None
+        self.executor = futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='AsyncMarket')
+
+    async def write(self, method, *args, **kwargs):
+        """Execute Market's write_operation method by writer thread and await its result."""
+
+        function = functools.partial(method.__wrapped__, self.market)
+        if self.market.metrics is not None:
+            function = self.market.metrics.wrap(function, method.__name__)
+        async with self.limit():
+            future = self.market.writer.put(function, *args, **kwargs)
             try:
-                if not df.iloc[i, 0].isnumeric():
-                    print('Table: Categories. Error with id in row:', i,
-                          'It will be deleted.')
-                    df = df.drop(i, axis=0)
-                    break
-                for word in df.iloc[i, 1].split(sep=' '):
-                    if not word.isalnum():
-                        print('Table: Categories. Error with title in row:', i,
-                              'It will be deleted.')
-                        df = df.drop(i, axis=0)
-                        break
-                for word in df.iloc[i, 2].split(sep=' '):
-                    if not word.isalnum():
-                        print(
-                            'Table: Categories. Error with description in row:',
-                            i, 'It will be deleted.')
-                        df = df.drop(i, axis=0)
-                        break
-            except:
-                pass
-        print(exception_counter, 'rows were deleted')
-        return df
+                return await asyncio.wrap_future(future)
+            except Exception as e:
+                print('An error occurred. Database wasn\'t updated.')
+                print('Error:', e)
+                return None
+
+    async def read(self, method, *args, **kwargs):
+        """Execute Market's read-only method on the thread pool and await its result."""
+
+        async with self.limit():
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor,
+                functools.partial(getattr(self.market, method.__name__), *args,
+                                  **kwargs))
+
+    def limit(self):
+        """Semaphore of calls in flight. It's created in the running loop."""
+
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_in_flight)
+        return self.semaphore
+
+    async def transactions_add(self, *args, **kwargs):
+        return await self.write(Market.transactions_add, *args, **kwargs)
+
+    async def delivery_add(self, *args, **kwargs):
+        return await self.write(Market.delivery_add, *args, **kwargs)
+
+    async def deliveries_import(self, *args, **kwargs):
+        return await self.write(Market.deliveries_import, *args, **kwargs)
+
+    async def sell_many(self, *args, **kwargs):
+        return await self.write(Market.sell_many, *args, **kwargs)
+
+    async def goods_sell(self, id):
+        return await self.write(Market.transactions_add,
+                                type='sell',
+                                subject_id=id)
+
+    async def category_sale_add(self, *args, **kwargs):
+        return await self.write(Market.category_sale_add, *args, **kwargs)
+
+    async def customer_sale_add(self, *args, **kwargs):
+        return await self.write(Market.customer_sale_add, *args, **kwargs)
+
+    async def revenue_stat(self, *args, **kwargs):
+        return await self.read(Market.revenue_stat, *args, **kwargs)
+
+    async def user_stat(self, *args, **kwargs):
+        return await self.read(Market.user_stat, *args, **kwargs)
+
+    async def table_size(self, *args, **kwargs):
+        return await self.read(Market.table_size, *args, **kwargs)
+
+    async def close(self):
+        """Wait for report threads and stop them."""
+
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.executor.shutdown)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
@@ -0,0 +1,381 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import sqlite3
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from DEschool_sberbank import Market
+from generate_data import generate
+
+
+def per_call(function, calls):
+    """Call function calls times and return average latency in microseconds."""
+
+    started = time.perf_counter()
+    for _ in range(calls):
+        function()
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+def bench_connection(market, calls=1000):
+    """
+    Per-call latency of a simple query: new connection on every call
+    (as Market did before) against the managed connection of Market.
+
+    """
+
+    def connect_per_call():
+        con = sqlite3.connect(market.database)
+        con.cursor().execute('SELECT COUNT(*) FROM Goods').fetchone()
+        con.commit()
+
+    def managed_connection():
+        market.con.cursor().execute('SELECT COUNT(*) FROM Goods').fetchone()
+        market.con.commit()
+
+    before = per_call(connect_per_call, calls)
+    after = per_call(managed_connection, calls)
+    print('Connection per call: %8.1f us' % before)
+    print('Managed connection:  %8.1f us (x%.1f)' % (after, before / after))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        latency = per_call(lambda: market.table_size('Goods'), calls)
+    print('Market.table_size:   %8.1f us' % latency)
+
+
+def bench_audit_log(market, calls=5000):
+    """Per-call latency of add_log in durable and buffered modes and log throughput."""
+
+    durable = per_call(
+        lambda: market.add_log('bench', 'log_table', 'durable', durable=True),
+        calls)
+    buffered = per_call(
+        lambda: market.add_log('bench', 'log_table', 'buffered'), calls)
+    market.log.flush()
+    stats = market.log.stats()
+    print('add_log durable:     %8.1f us' % durable)
+    print('add_log buffered:    %8.1f us (x%.1f)' %
+          (buffered, durable / buffered))
+    print('Log throughput: %.0f entries/s in %s flushes' %
+          (stats['entries_per_second'], stats['flushes']))
+
+
+def bench_checkout(market, basket_size=50, baskets=20):
+    """Latency of a basket checkout: one sell per good against sell_many."""
+
+    market.goods_add('Checkout good', 100, count=2 * basket_size * baskets)
+    ids = [
+        row[0] for row in market.reader().execute(
+            'SELECT id FROM Goods WHERE title = ?', ['Checkout good'])
+    ]
+    single_ids = iter(ids[:basket_size * baskets])
+    basket_ids = iter(ids[basket_size * baskets:])
+
+    def single_sells():
+        for _ in range(basket_size):
+            market.transactions_add(type='sell',
+                                    subject_id=next(single_ids),
+                                    customer_id=1)
+
+    def basket_sell():
+        market.sell_many([next(basket_ids) for _ in range(basket_size)],
+                         customer_id=1)
+
+    before = per_call(single_sells, baskets)
+    after = per_call(basket_sell, baskets)
+    print('Checkout of %s goods by transactions_add: %8.0f us' %
+          (basket_size, before))
+    print('Checkout of %s goods by sell_many:        %8.0f us (x%.1f)' %
+          (basket_size, after, before / after))
+
+
+def bench_reports(market, calls=100):
+    """Latency of reports over the last year."""
+
+    start_date = datetime.date.today() - datetime.timedelta(days=365)
+
+    def uncached():
+        market.cache_clear()
+        market.revenue_stat(start_date, verbose=False)
+
+    latency = per_call(uncached, calls)
+    cached = per_call(lambda: market.revenue_stat(start_date, verbose=False),
+                      calls)
+    print('Market.revenue_stat: %8.1f us, cached: %6.1f us' %
+          (latency, cached))
+    latency = per_call(
+        lambda: market.user_stat(start_date, level=[0.2, 0.5, 1],
+                                 verbose=False), calls)
+    print('Market.user_stat:    %8.1f us' % latency)
+    print('Report cache: %s' % market.cache_stats())
+
+
+def bench_inventory(units=10000, sells=1000):
+    """Delivery of units and sells of them in 'units' inventory against 'ledger' one."""
+
+    for inventory in Market.inventory_modes:
+        with contextlib.redirect_stdout(io.StringIO()):
+            market = Market(inventory, rebuild=True, inventory=inventory)
+        with market:
+            started = time.perf_counter()
+            stock_id = market.goods_add('Ledger good', 100, count=units)
+            delivery = time.perf_counter() - started
+            if inventory == 'units':
+                ids = [
+                    row[0] for row in market.reader().execute(
+                        'SELECT id FROM Goods WHERE title = ?', ['Ledger good'])
+                ]
+                stock_id = ids[-1]
+                units_left = iter(ids)
+                sell = lambda: market.transactions_add('sell', next(units_left))
+            else:
+                sell = lambda: market.transactions_add('sell', stock_id)
+            level = lambda: market.stock_level(stock_id)
+            print('%-6s delivery of %s units: %8.0f us, sell: %6.1f us, '
+                  'stock level: %6.1f us' %
+                  (inventory, units, delivery * 1e6, per_call(sell, sells),
+                   per_call(level, sells)))
+
+
+def bench_instrumentation(calls=2000):
+    """Latency of a write and a read without instrumentation and with it."""
+
+    for instrument in (False, True):
+        with contextlib.redirect_stdout(io.StringIO()):
+            market = Market('bench', instrument=instrument)
+        with market:
+            write = per_call(
+                lambda: market.transactions_add('delivery', -1, total=1),
+                calls)
+            read = per_call(lambda: market.stock_level(1), calls)
+            print('instrument=%-5s delivery: %6.1f us, stock_level: %6.1f us'
+                  % (instrument, write, read))
+            if instrument:
+                stats = market.stats()['methods']['transactions_add.delivery']
+                print('Histogram of transactions_add.delivery: %s' %
+                      stats['histogram'])
+
+
+def bench_cold_start(runs=5):
+    """
+    Wall time of a new python process, that opens existing database 'bench' and sells
+    one good. Importing pandas beforehand shows the cost of the eager import.
+
+    """
+
+    script = '''
+import sys
+sys.path.insert(0, %r)
+%s
+from DEschool_sberbank import Market
+with Market('bench') as market:
+    market.goods_add('Cold good', 1, count=1)
+    good_id = market.con.execute('SELECT max(id) FROM Goods').fetchone()[0]
+    market.transactions_add('sell', good_id)
+assert ('pandas' in sys.modules) == %s
+'''
+    directory = os.path.dirname(os.path.abspath(__file__))
+    timings = {}
+    for pandas in (False, True):
+        code = script % (directory, 'import pandas' if pandas else '', pandas)
+        elapsed = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, '-W', 'ignore', '-c', code],
+                           check=True,
+                           stdout=subprocess.DEVNULL)
+            elapsed.append(time.perf_counter() - started)
+        timings[pandas] = min(elapsed) * 1e3
+    print('Cold sell: %6.0f ms, with pandas imported: %6.0f ms (x%.1f)' %
+          (timings[False], timings[True], timings[True] / timings[False]))
+
+
+def timed(function):
+    """Call function with its output suppressed and return its result and wall time in seconds."""
+
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function()
+    return result, time.perf_counter() - started
+
+
+def run_suite(directory, rows=1000, calls=1000):
+    """
+    Benchmark suite over generated data of rows goods and customers (see generate_data):
+    construction of Market with import, opening of existing database, merge of locators,
+    sell, return, delivery_add and deliveries_import throughput, reports and cloning of the database
+    in memory by snapshot.
+    Return dict of results: seconds (_s), microseconds per call (_us) or calls per second.
+
+    """
+
+    import pandas  # imported beforehand, so it isn't a part of import time
+
+    results = {}
+    _, results['generate_s'] = timed(lambda: generate(directory, rows))
+    market, results['import_s'] = timed(lambda: Market('suite', rebuild=True))
+    results['import_rows_per_s'] = 2 * rows / results['import_s']
+    _, results['locators_merge_s'] = timed(
+        lambda: market.locators_insert(market.locators_df))
+
+    with market:
+        ids = [
+            row[0] for row in market.reader().execute(
+                'SELECT id FROM Goods WHERE delflg = 0 ORDER BY id LIMIT ?',
+                [calls])
+        ]
+        _, elapsed = timed(lambda: [
+            market.transactions_add('sell', good_id, customer_id=good_id)
+            for good_id in ids
+        ])
+        results['sell_per_s'] = len(ids) / elapsed
+        _, elapsed = timed(
+            lambda: [market.transactions_add('return', good_id) for good_id in ids])
+        results['return_per_s'] = len(ids) / elapsed
+        _, elapsed = timed(lambda: [
+            market.delivery_add('Suite good', 100, 1, quantity=10)
+            for _ in range(calls // 10)
+        ])
+        results['delivery_add_us'] = elapsed / (calls // 10) * 1e6
+        manifest = pandas.DataFrame({
+            'title': ['Manifest good %s' % i for i in range(calls)],
+            'price': 100,
+            'category_id': 1,
+            'quantity': 10
+        })
+        _, elapsed = timed(lambda: market.deliveries_import(manifest))
+        results['deliveries_import_line_us'] = elapsed / calls * 1e6
+
+        start_date = datetime.date.today() - datetime.timedelta(days=365)
+        for report in ('revenue_stat', 'user_stat'):
+            method = getattr(market, report)
+
+            def uncached():
+                market.cache_clear()
+                method(start_date, verbose=False)
+
+            results[report + '_us'] = per_call(uncached, 100)
+            results[report + '_cached_us'] = per_call(
+                lambda: method(start_date, verbose=False), 100)
+
+    market, results['open_s'] = timed(lambda: Market('suite'))
+    with market:
+        snapshot, results['snapshot_s'] = timed(market.snapshot)
+    clone, results['clone_s'] = timed(
+        lambda: Market(':memory:', snapshot=snapshot))
+    clone.close()
+    snapshot.close()
+    return results
+
+
+def suite_report(rows, results):
+    """Return machine-readable report of run_suite: results with versions and commit."""
+
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'rows': rows,
+        'results': results,
+    }
+
+
+def bench_concurrent_sell(threads=8, units=2000):
+    """
+    Stress test of concurrent mode: threads sell units of shared stock in random order.
+    Check, that each unit is sold once, and report throughput.
+
+    """
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        market = Market('concurrent', concurrent=True)
+        market.goods_add('Stress good', 100, count=units)
+    with market:
+        ids = [
+            row[0] for row in market.reader().execute(
+                'SELECT id FROM Goods WHERE title = ?', ['Stress good'])
+        ]
+
+        def cashier():
+            for good_id in random.sample(ids, len(ids)):
+                market.transactions_add(type='sell', subject_id=good_id)
+
+        workers = [threading.Thread(target=cashier) for _ in range(threads)]
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        elapsed = time.perf_counter() - started
+
+        sold = market.reader().execute(
+            '''SELECT count(*), count(DISTINCT subject_id) FROM Transactions
+               WHERE type = 'sell' AND subject_id IN (%s)''' %
+            ','.join(map(str, ids))).fetchone()
+        calls = threads * len(ids)
+        print('Concurrent sell: %s threads, %s calls, %s units sold, '
+              'double sells: %s' % (threads, calls, sold[0], sold[0] - sold[1]))
+        print('Throughput: %.0f calls/s, %.1f calls per commit' %
+              (calls / elapsed, market.writer.calls / market.writer.commits))
+        assert sold[0] == sold[1] == units
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of Market.')
+    parser.add_argument('--rows',
+                        type=float,
+                        default=1000,
+                        help='Rows of generated goods and customers, e.g. 1e3 - 1e7')
+    parser.add_argument('--output', help='Write results of the suite into json file')
+    parser.add_argument('--suite-only',
+                        action='store_true',
+                        help='Run only the suite, without micro benchmarks')
+    args = parser.parse_args()
+    output = args.output and os.path.abspath(args.output)
+    rows = int(args.rows)
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        report = suite_report(rows, run_suite(directory, rows))
+        for name, value in report['results'].items():
+            print('%-24s %12.4g' % (name, value))
+        if output:
+            with open(output, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+        if args.suite_only:
+            sys.exit()
+
+        generate(directory)
+        with contextlib.redirect_stdout(io.StringIO()):
+            market = Market('bench', rebuild=True)
+        with market:
+            print('Hot queries use indexes: %s' %
+                  ', '.join(market.check_query_plans()))
+            bench_connection(market)
+            bench_audit_log(market)
+            bench_checkout(market)
+            bench_reports(market)
+        bench_instrumentation()
+        bench_cold_start()
+        bench_inventory()
+        bench_concurrent_sell()
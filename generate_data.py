@@ -0,0 +1,169 @@
+import argparse
+import os
+import random
+import time
+
+from DEschool_sberbank import Market
+
+# Names of source files by table
+files = {table: file for file, table in Market.import_files}
+
+first_names = [
+    'Ivan', 'Anna', 'Olga', 'Oleg', 'Pavel', 'Maria', 'Petr', 'Elena',
+    'Sergey', 'Irina', 'Dmitry', 'Natalia', 'Alexey', 'Tatiana', 'Nikolay',
+    'Svetlana'
+]
+
+last_names = [
+    'Ivanov', 'Petrov', 'Sidorov', 'Smirnov', 'Kuznetsov', 'Popov', 'Vasiliev',
+    'Sokolov', 'Mikhailov', 'Novikov', 'Fedorov', 'Morozov', 'Volkov',
+    'Alekseev', 'Lebedev', 'Semenov'
+]
+
+goods_words = [
+    'Hammer', 'Nails', 'Apple', 'Milk', 'Bread', 'Drill', 'Paint', 'Brush',
+    'Cheese', 'Tea', 'Coffee', 'Saw', 'Glue', 'Tape', 'Juice', 'Rice'
+]
+
+
+def letters(number):
+    """Return number written by letters a-z, e.g. 0 - 'a', 27 - 'bb'."""
+
+    word = ''
+    while True:
+        number, rest = divmod(number, 26)
+        word = chr(97 + rest) + word
+        if not number:
+            return word
+
+
+def invalid_lines(layout, rng):
+    """
+    Yield invalid lines of the source table in turn: wrong ids, too few separators,
+    empty lines and values, that fail validation of the table.
+
+    """
+
+    samples = {
+        'categories': [
+            'x,Category,Description', 'broken', '', '0,Bad!,Description',
+            '0,Category,  double  spaces'
+        ],
+        'goods': ['x,Good,10,1', 'broken', '', '0,Good,ten,1', '0,,10,1'],
+        'customers': [
+            'x,Ivan,Ivanov,ivan@mail.ru,male', 'broken', '',
+            '0,Iv4n,Ivanov,ivan@mail.ru,male', '0,Ivan,Ivanov,ivan@mail.ru,other'
+        ],
+    }[layout]
+    while True:
+        yield rng.choice(samples)
+
+
+def write_table(path, header, lines, rows, invalid_share, invalid, rng):
+    """
+    Write header and rows lines into csv file. Invalid lines are inserted between valid
+    ones with probability invalid_share, so ids of valid lines are 1..rows.
+    Return number of written valid and invalid lines.
+
+    """
+
+    written_invalid = 0
+    with open(path, 'w', encoding='utf-8', newline='\n') as f:
+        f.write(header + '\n')
+        for line in lines:
+            f.write(line + '\n')
+            if invalid_share and rng.random() < invalid_share:
+                f.write(next(invalid) + '\n')
+                written_invalid += 1
+    return {'rows': rows, 'invalid': written_invalid}
+
+
+def generate(directory='.',
+             rows=1000,
+             categories=None,
+             invalid_share=0.01,
+             comma_share=0.01,
+             seed=0):
+    """
+    Write categoris_table.csv, goods_table.csv and Persons_table.csv in formats of Market
+    into directory. Output is reproducible for the same arguments.
+
+    Parameters
+    ----------
+        rows : Number of valid goods and customers, e.g. 1e3 - 1e7
+
+        categories : Number of categories. Default: rows / 100, from 10 to 1000
+
+        invalid_share : Share of invalid lines, inserted between valid ones (see invalid_lines)
+
+        comma_share : Share of goods with comma in the title, e.g. 'Nails, big'.
+                      Separators split fields from the left, so such goods are rejected.
+
+        seed : Seed of random generator
+
+    Returns
+    -------
+        Dict of numbers of valid and invalid lines by table.
+
+    """
+
+    rows = int(rows)
+    if categories is None:
+        categories = min(max(rows // 100, 10), 1000)
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+
+    def category_lines():
+        for i in range(1, categories + 1):
+            yield '%s,Category %s,Goods of category %s' % (i, letters(i), i)
+
+    def goods_lines():
+        for i in range(1, rows + 1):
+            title = '%s %s' % (rng.choice(goods_words), letters(i % 5000))
+            if comma_share and rng.random() < comma_share:
+                title = '%s, big' % title
+            yield '%s,%s,%s,%s' % (i, title, rng.randint(1, 10000),
+                                   rng.randint(1, categories))
+
+    def customer_lines():
+        # Names repeat, so customers with the same names are merged into locators
+        for i in range(1, rows + 1):
+            first_name = rng.choice(first_names)
+            last_name = rng.choice(last_names) + letters(
+                rng.randrange(max(rows // 50, 1)))
+            email = '%s.%s%s@mail.ru' % (first_name.lower(), last_name.lower(),
+                                         i)
+            if invalid_share and rng.random() < invalid_share:
+                email = email.replace('@', '')
+            yield '%s,%s,%s,%s,%s' % (i, first_name, last_name, email,
+                                      rng.choice(['male', 'female', 'Male']))
+
+    stats = {}
+    for table, lines, count in (('categories', category_lines(), categories),
+                                ('goods', goods_lines(), rows),
+                                ('customers', customer_lines(), rows)):
+        stats[table] = write_table(os.path.join(directory, files[table]),
+                                   ','.join(Market.import_layouts[table]),
+                                   lines, count, invalid_share,
+                                   invalid_lines(table, rng), rng)
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate source csv files of Market.')
+    parser.add_argument('directory', nargs='?', default='.')
+    parser.add_argument('--rows', type=float, default=1000)
+    parser.add_argument('--categories', type=int, default=None)
+    parser.add_argument('--invalid-share', type=float, default=0.01)
+    parser.add_argument('--comma-share', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    stats = generate(args.directory, args.rows, args.categories,
+                     args.invalid_share, args.comma_share, args.seed)
+    for table, table_stats in stats.items():
+        print('%s: %s rows, %s invalid lines' %
+              (files[table], table_stats['rows'], table_stats['invalid']))
+    print('Generated in %.1f s' % (time.perf_counter() - started))
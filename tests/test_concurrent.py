@@ -0,0 +1,54 @@
+import threading
+
+import pandas as pd
+import pytest
+
+from DEschool_sberbank import Market
+from generate_data import generate
+
+
+@pytest.fixture
+def market(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    generate(tmp_path, rows=2000, invalid_share=0)
+    with Market('shop', concurrent=True) as market:
+        yield market
+
+
+def count(market, rows):
+    return market.reader().execute('''select count(*) from ''' +
+                                   rows).fetchone()[0]
+
+
+def test_bulk_load_during_sells(market):
+    goods = [
+        row[0] for row in market.con.execute(
+            '''select id from Goods where delflg = 0 order by id limit 1000''')
+    ]
+    last_id = market.con.execute('''select max(id) from Goods''').fetchone()[0]
+    rows = 5000
+    df = pd.DataFrame({
+        'id': range(last_id + 1, last_id + rows + 1),
+        'title': 'Bulk',
+        'price': 10,
+        'categoryId': 1,
+    })
+
+    def cashier(ids):
+        for good_id in ids:
+            market.goods_sell(good_id)
+
+    cashiers = [
+        threading.Thread(target=cashier, args=(goods[i::4], ))
+        for i in range(4)
+    ]
+    for thread in cashiers:
+        thread.start()
+    inserted = market.goods_insert(df, batch_size=10)
+    for thread in cashiers:
+        thread.join()
+
+    assert inserted == rows
+    assert count(market, '''Goods where title = \'Bulk\'''') == rows
+    assert count(market, '''Transactions where type = \'sell\'''') == len(goods)
+    assert count(market, '''Goods where delflg = 1''') == len(goods)
@@ -0,0 +1,35 @@
+import io
+
+import pandas as pd
+import pytest
+
+from DEschool_sberbank import Market
+
+
+@pytest.fixture(params=['units', 'ledger'])
+def market(request):
+    files = {
+        'categories': io.StringIO('id,title,description\n1,Paint,Colors\n'),
+        'goods': io.StringIO('id,title,price,categoryId\n1,Paint,500,1\n'),
+        'customers':
+        io.StringIO('id,first_name,last_name,email,gender\n'
+                    '1,Ivan,Ivanov,ivan@mail.ru,male\n'),
+    }
+    with Market(':memory:', files=files, inventory=request.param) as market:
+        yield market
+
+
+@pytest.mark.parametrize('title', [None, float('nan'), ''])
+def test_missing_title_is_rejected(market, title):
+    result = market.deliveries_import(
+        pd.DataFrame({
+            'title': ['Good', title, 'Other'],
+            'price': [10, 5, 9.99],
+            'quantity': [1, 2, 3.0]
+        }))
+
+    assert result['status'].tolist() == ['delivered', 'rejected', 'delivered']
+    assert result['reason'].tolist() == ['', 'title', '']
+    deliveries = market.con.execute(
+        '''select title, quantity, price from Deliveries order by id''')
+    assert deliveries.fetchall() == [('Good', 1, 10), ('Other', 3, 9.99)]
@@ -0,0 +1,98 @@
+import io
+
+import pytest
+
+from DEschool_sberbank import Market
+
+
+@pytest.fixture
+def market():
+    files = {
+        'categories':
+        io.StringIO('id,title,description\n1,Paint,Colors\n2,Fruit,Food\n'),
+        'goods':
+        io.StringIO('id,title,price,categoryId\n1,Paint,500,1\n2,Paint,500,1\n'
+                    '3,Apple,100,2\n'),
+        'customers':
+        io.StringIO('id,first_name,last_name,email,gender\n'
+                    '1,Ivan,Ivanov,ivan@mail.ru,male\n'),
+    }
+    with Market(':memory:', files=files) as market:
+        yield market
+
+
+def last_refund(market):
+    return market.con.execute(
+        '''select subject_id, total from Transactions where type = \'return\'
+           order by id desc limit 1''').fetchone()
+
+
+def test_return_of_unit_sold_before_migration(market):
+    for good_id in [1, 2, 3]:
+        market.goods_sell(good_id)
+    market.inventory_migrate()
+
+    # Sells of Paint have subject_id 1 and 2, they must not price a return of Apple
+    apple_id = market.con.execute(
+        '''select id from Stock where title = \'Apple\'''').fetchone()[0]
+    market.transactions_add(type='return', subject_id=apple_id)
+
+    assert last_refund(market) == (apple_id, 100)
+    assert market.stock_level(apple_id) == 1
+
+
+def test_return_of_ledger_sell_with_discount(market):
+    market.inventory_migrate()
+    apple_id = market.goods_add('Apple', 100, 2, count=2)
+    market.customer_sale_add(customer_id=1, discount=50, active=1)
+    market.transactions_add(type='sell',
+                            subject_id=apple_id,
+                            quantity=2,
+                            customer_id=1)
+    market.transactions_add(type='return', subject_id=apple_id)
+
+    assert last_refund(market) == (apple_id, 50)
+    assert market.stock_level(apple_id) == 2
+
+
+def stock_state(market, stock_id):
+    return (market.stock_level(stock_id), *[
+        market.con.execute('''select count(*) from %s''' % table).fetchone()[0]
+        for table in ['Transactions', 'Revenue_daily', 'Stock_movements']
+    ])
+
+
+@pytest.mark.parametrize('quantity', [-5, 0, 1.5, True, '2', None])
+def test_ledger_rejects_quantity(market, quantity):
+    market.inventory_migrate()
+    apple_id = market.goods_add('Apple', 100, 2, count=2)
+    market.transactions_add(type='sell', subject_id=apple_id)
+    state = stock_state(market, apple_id)
+
+    for type in ['sell', 'return']:
+        market.transactions_add(type=type,
+                                subject_id=apple_id,
+                                quantity=quantity)
+        assert stock_state(market, apple_id) == state
+    assert market.goods_add('Apple', 100, 2, count=quantity) is None
+    assert stock_state(market, apple_id) == state
+
+
+def test_stock_level_by_article_before_and_after_migration(market):
+    # Paint of another category is another article
+    market.goods_add('Paint', 500, 2, count=3)
+    assert market.stock_level(1) == 2
+
+    market.inventory_migrate()
+    paint_id = market.con.execute(
+        '''select id from Stock where title = \'Paint\' and categoryId = 1'''
+    ).fetchone()[0]
+    assert market.stock_level(paint_id) == 2
+
+
+def test_ledger_rejects_sold_goods(market):
+    market.inventory_migrate()
+    assert market.goods_add('Apple', 100, 2, count=1, delflg=1) is None
+    assert market.con.execute('''select count(*) from Goods''').fetchone()[0] == 3
+    assert market.con.execute(
+        '''select sum(quantity) from Stock''').fetchone()[0] == 3
@@ -0,0 +1,33 @@
+import pytest
+
+from DEschool_sberbank import Market
+from generate_data import generate
+
+
+@pytest.fixture(scope='module')
+def market(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('source')
+    generate(directory, rows=200)
+    files = {
+        table: str(directory / file)
+        for file, table in Market.import_files
+    }
+    with Market(':memory:', files=files) as market:
+        yield market
+
+
+@pytest.mark.parametrize('name', list(Market.hot_queries))
+def test_hot_query_searches_index(market, name):
+    sql, params = Market.hot_queries[name]
+    plan = market.query_plan(sql, params)
+    assert market.plan_scans(plan) == [], plan
+
+
+def test_check_query_plans(market):
+    assert list(market.check_query_plans()) == list(Market.hot_queries)
+
+
+def test_plan_scans_finds_full_scan(market):
+    plan = market.query_plan('''select id from Goods where title = ?''',
+                             ['title'])
+    assert market.plan_scans(plan) == ['SCAN Goods']